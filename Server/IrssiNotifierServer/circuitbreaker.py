@@ -0,0 +1,115 @@
+import logging
+import random
+import time
+from google.appengine.api import memcache
+
+# requests are counted in fixed windows, the circuit opens when too many of them fail or are slow
+WindowSize = 60
+MinRequests = 10
+ErrorRateThreshold = 0.5
+SlowRequestTime = 5
+SlowRateThreshold = 0.5
+# after OpenTime a single probe request is let through, the circuit closes again if it succeeds
+OpenTime = 30
+ProbeTimeout = 15
+MaxJitter = 30
+
+StateClosed = 'closed'
+StateOpen = 'open'
+StateHalfOpen = 'half-open'
+
+Counters = ['requests', 'errors', 'slow']
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, retry_after):
+        Exception.__init__(self, "Circuit open, retry after %.1f seconds" % retry_after)
+        self.retry_after = retry_after
+
+
+def jittered_delay(retry_after):
+    # spread the held requests so that they do not all hit the upstream at the same moment when it recovers
+    return int(retry_after + random.uniform(1, MaxJitter))
+
+
+class CircuitBreaker(object):
+    """Circuit breaker for an upstream service, the state is shared by all instances through memcache."""
+
+    def __init__(self, name, client=memcache):
+        self.name = name
+        self.client = client
+
+    def _key(self, suffix):
+        return 'circuit-%s-%s' % (self.name, suffix)
+
+    def _window_keys(self):
+        window = int(time.time() / WindowSize)
+        return dict((counter, self._key('%s-%s' % (counter, window))) for counter in Counters)
+
+    def get_state(self):
+        open_until = self.client.get(self._key('open'))
+        if open_until is None:
+            return StateClosed, 0
+        remaining = open_until - time.time()
+        if remaining > 0:
+            return StateOpen, remaining
+        return StateHalfOpen, 0
+
+    def before_request(self):
+        (state, remaining) = self.get_state()
+        if state == StateOpen:
+            raise CircuitOpenError(remaining)
+        if state == StateHalfOpen:
+            if not self.client.add(self._key('probe'), True, time=ProbeTimeout):
+                raise CircuitOpenError(ProbeTimeout)  # someone else is probing
+            logging.info("Circuit %s half-open, sending probe request" % self.name)
+            self._count_transition(StateHalfOpen)
+
+    def record(self, success, latency):
+        slow = latency > SlowRequestTime
+        keys = self._window_keys()
+        counts = self.client.offset_multi({keys['requests']: 1,
+                                           keys['errors']: 0 if success else 1,
+                                           keys['slow']: 1 if slow else 0}, initial_value=0)
+
+        (state, _) = self.get_state()
+        if state == StateHalfOpen:
+            if success and not slow:
+                self._close()
+            else:
+                self._open("probe failed")
+        elif state == StateClosed:
+            requests = counts.get(keys['requests']) or 0
+            if requests < MinRequests:
+                return
+            errors = counts.get(keys['errors']) or 0
+            slow_requests = counts.get(keys['slow']) or 0
+            if float(errors) / requests >= ErrorRateThreshold:
+                self._open("%s of %s requests failed" % (errors, requests))
+            elif float(slow_requests) / requests >= SlowRateThreshold:
+                self._open("%s of %s requests were slow" % (slow_requests, requests))
+
+    def _open(self, reason):
+        logging.warn("Opening circuit %s for %s seconds: %s" % (self.name, OpenTime, reason))
+        self.client.set(self._key('open'), time.time() + OpenTime)
+        self.client.delete(self._key('probe'))
+        self._count_transition(StateOpen)
+
+    def _close(self):
+        logging.info("Closing circuit %s" % self.name)
+        # errors from before the outage must not trip the circuit again
+        self.client.delete_multi(self._window_keys().values() + [self._key('open'), self._key('probe')])
+        self._count_transition(StateClosed)
+
+    def _count_transition(self, state):
+        self.client.incr(self._key('transitions-%s' % state), initial_value=0)
+
+    def get_stats(self):
+        (state, remaining) = self.get_state()
+        window_keys = self._window_keys()
+        transition_keys = dict((s, self._key('transitions-%s' % s)) for s in [StateOpen, StateHalfOpen, StateClosed])
+        values = self.client.get_multi(window_keys.values() + transition_keys.values())
+        return {'state': state,
+                'open_remaining': remaining,
+                'window': dict((c, int(values.get(k) or 0)) for c, k in window_keys.items()),
+                'transitions': dict((s, int(values.get(k) or 0)) for s, k in transition_keys.items())}
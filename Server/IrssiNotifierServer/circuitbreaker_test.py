@@ -0,0 +1,54 @@
+import time
+import unittest
+import circuitbreaker
+from circuitbreaker import CircuitBreaker, CircuitOpenError
+from mockmemcache import MockMemcache
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker('test', client=MockMemcache())
+
+    def fail_requests(self, count):
+        for i in range(count):
+            self.breaker.before_request()
+            self.breaker.record(False, 0.1)
+
+    def test_opens_on_error_rate(self):
+        self.fail_requests(circuitbreaker.MinRequests - 1)
+        self.assertEqual(circuitbreaker.StateClosed, self.breaker.get_state()[0])
+
+        self.fail_requests(1)
+        self.assertEqual(circuitbreaker.StateOpen, self.breaker.get_state()[0])
+        self.assertRaises(CircuitOpenError, self.breaker.before_request)
+        self.assertEqual(1, self.breaker.get_stats()['transitions']['open'])
+
+    def test_opens_on_latency(self):
+        for i in range(circuitbreaker.MinRequests):
+            self.breaker.record(True, circuitbreaker.SlowRequestTime + 1)
+        self.assertEqual(circuitbreaker.StateOpen, self.breaker.get_state()[0])
+
+    def test_half_open_probe(self):
+        self.fail_requests(circuitbreaker.MinRequests)
+        self.breaker.client.set(self.breaker._key('open'), time.time() - 1)  # open time is over
+        self.assertEqual(circuitbreaker.StateHalfOpen, self.breaker.get_state()[0])
+
+        self.breaker.before_request()  # the probe
+        self.assertRaises(CircuitOpenError, self.breaker.before_request)
+
+        self.breaker.record(True, 0.1)
+        self.assertEqual(circuitbreaker.StateClosed, self.breaker.get_state()[0])
+        self.breaker.before_request()
+
+        stats = self.breaker.get_stats()
+        self.assertEqual({'open': 1, 'half-open': 1, 'closed': 1}, stats['transitions'])
+        self.assertEqual(0, stats['window']['errors'])
+
+    def test_failed_probe_reopens(self):
+        self.fail_requests(circuitbreaker.MinRequests)
+        self.breaker.client.set(self.breaker._key('open'), time.time() - 1)
+
+        self.fail_requests(1)
+        self.assertEqual(circuitbreaker.StateOpen, self.breaker.get_state()[0])
+        self.assertEqual(2, self.breaker.get_stats()['transitions']['open'])
@@ -1,5 +1,7 @@
 import traceback
 from google.appengine.api import users
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
 
 import webapp2
 import logging
@@ -10,11 +12,18 @@ import gcmhelper
 import jinja2
 import os
 import json
+import hashlib
+import math
+import time
+import ratelimit
 
 jinja_environment = jinja2.Environment(loader=jinja2.FileSystemLoader(os.path.dirname(__file__)))
 MinAndroidVersion = 8
 MinScriptVersion = 2
 LatestScriptVersion = 18
+MaxMessageBatchSize = 100
+# from this protocol version on messages are sent as json objects instead of json encoded strings
+MessageObjectsProtocol = 2
 
 
 def getAndroidServerMessage(data):
@@ -45,6 +54,20 @@ def getIrssiServerMessage(data):
     return True, ""
 
 
+class StageTimer(object):
+    def __init__(self):
+        self.last = time.time()
+        self.stages = []
+
+    def mark(self, stage):
+        now = time.time()
+        self.stages.append((stage, (now - self.last) * 1000))
+        self.last = now
+
+    def __str__(self):
+        return ', '.join(['%s;dur=%.1f' % stage for stage in self.stages])
+
+
 class BaseController(webapp2.RequestHandler):
     data = {}
 
@@ -86,6 +109,23 @@ class BaseController(webapp2.RequestHandler):
             return False
         return True
 
+    def check_rate_limit(self, count=1):
+        retry_after = ratelimit.take(self.irssi_user.api_token, count)
+        if retry_after == 0:
+            return True
+
+        logging.warn("Rate limit exceeded for user %s, suppressing %s messages" % (self.irssi_user.email, count))
+        gcmhelper.add_suppressed_notifications(self.irssi_user, count)
+        self.response.status = '429 Too Many Requests'
+        self.response.headers['Retry-After'] = str(int(math.ceil(retry_after)))
+        return False
+
+    def get_protocol(self):
+        try:
+            return int(self.data.get("protocol", 1))
+        except ValueError:
+            return 1
+
     def decode_params(self, request):
         d = request.body
         pairs = d.split('&')
@@ -123,6 +163,7 @@ class WebController(BaseController):
 
         if user is not None:
             tokens = dao.get_gcm_tokens_for_user(user)
+            (notification_count, notification_time) = dao.get_notification_stats(user)
 
             for token in tokens:
                 if token.registration_date is not None:
@@ -134,15 +175,12 @@ class WebController(BaseController):
                 license_type = 'Plus'
                 license_timestamp = user.license_timestamp
 
-                if user.last_notification_time is not None:
-                    last_notification_time = user.last_notification_time
+                if notification_time is not None:
+                    last_notification_time = notification_time
                 else:
                     last_notification_time = 'Never'
 
-                if user.notification_count_since_licensed is not None:
-                    notification_count_since_licensed = user.notification_count_since_licensed
-                else:
-                    notification_count_since_licensed = 0
+                notification_count_since_licensed = notification_count
 
             irssi_script_version = user.irssi_script_version
             if irssi_script_version is None:
@@ -151,7 +189,7 @@ class WebController(BaseController):
             if user.registration_date is not None:
                 registration_date = user.registration_date
 
-            if user.last_notification_time is not None:
+            if notification_time is not None:
                 irssi_working = True
 
         template_values = {
@@ -189,6 +227,9 @@ class SettingsController(BaseController):
         dao.save_settings(self.irssi_user, self.data["RegistrationId"], bool(int(self.data["Enabled"])),
                           self.data["Name"])
 
+        if "CoalesceWindow" in self.data:
+            dao.save_push_coalesce_window(self.irssi_user, int(self.data["CoalesceWindow"]))
+
         responseJson = json.dumps({'response': 'ok'})
 
         self.response.out.write(responseJson)
@@ -196,26 +237,74 @@ class SettingsController(BaseController):
 
 class MessageController(BaseController):
     def post(self):
+        timer = StageTimer()
         success = self.initController("MessageController.post()", ["message", "channel", "nick", "version"])
+        timer.mark("auth")
         if not success:
             return self.response
 
+        idempotency_key = self.data.get("idempotencyKey")
+        if idempotency_key:
+            if len(idempotency_key) > dao.MaxIdempotencyKeyLength:
+                self.response.status = '400 Bad Request'
+                return self.response
+
+            (process, response) = dao.begin_idempotent_request(self.irssi_user, idempotency_key)
+            if not process:
+                if response is None:
+                    logging.info("Request with idempotency key %s still in progress" % idempotency_key)
+                    self.response.status = '409 Conflict'
+                    self.response.headers['Retry-After'] = '1'
+                else:
+                    logging.info("Replaying response for idempotency key %s" % idempotency_key)
+                    self.response.out.write(response)
+                return self.response
+
+        if not self.check_rate_limit():
+            self.abort_idempotent_request(idempotency_key)
+            return self.response
+
         (cont, serverMessage) = getIrssiServerMessage(self.data)
         if not cont:
+            self.abort_idempotent_request(idempotency_key)
             self.response.out.write(serverMessage)
             return self.response
 
         try:
-            message = dao.add_message(self.irssi_user, self.data["message"], self.data['channel'], self.data['nick'])
-            dao.update_irssi_user_from_message(self.irssi_user, int(self.data['version']))
-            gcmhelper.send_gcm_to_user_deferred(self.irssi_user, message.to_gcm_json())
+            self.ingest_message(timer).get_result()
         except:
             logging.warn("Error while creating new message, exception %s", traceback.format_exc())
+            self.abort_idempotent_request(idempotency_key)
             self.response.status = '400 Bad Request'
             return self.response
 
+        if idempotency_key:
+            dao.finish_idempotent_request(self.irssi_user, idempotency_key, serverMessage)
+            timer.mark("idempotency")
+
+        logging.debug("Message stage timings: %s" % timer)
+        self.response.headers['Server-Timing'] = str(timer)
         self.response.out.write(serverMessage)
 
+    def abort_idempotent_request(self, idempotency_key):
+        # let a retry with the same key try again
+        if idempotency_key:
+            dao.abort_idempotent_request(self.irssi_user, idempotency_key)
+
+    @ndb.tasklet
+    def ingest_message(self, timer):
+        # storing the message and updating the user are independent, but a push is only sent for a stored message
+        message_future = dao.add_message_async(self.irssi_user, self.data["message"], self.data['channel'],
+                                               self.data['nick'])
+        user_future = dao.update_irssi_user_from_message_async(self.irssi_user, int(self.data['version']))
+
+        message = yield message_future
+        timer.mark("store")
+        yield gcmhelper.send_gcm_to_user_async(self.irssi_user, message)
+        timer.mark("push")
+        yield user_future
+        timer.mark("user")
+
     def get(self):
         val = self.initController("MessageController.get()", ["version"])
         if not val:
@@ -232,13 +321,90 @@ class MessageController(BaseController):
         else:
             timestamp = 0
 
-        messages = dao.get_messages(self.irssi_user, timestamp)
-        message_jsons = [message.to_json() for message in messages]
-        response_json = json.dumps({"servermessage": serverMessage, "messages": message_jsons})
+        (version, version_timestamp) = dao.get_message_version(self.irssi_user)
+        self.response.headers['Cache-Control'] = 'private, no-cache'
+        if time.time() - version_timestamp >= dao.MessageVersionSettleTime:
+            etag = hashlib.sha1(json.dumps([version, serverMessage, timestamp, self.data.get("pageSize"),
+                                            self.data.get("cursor"), self.get_protocol()])).hexdigest()
+            # weak, the frontend gzips the body for clients that accept it
+            self.response.headers['ETag'] = 'W/"%s"' % etag
+            if etag in self.request.if_none_match:
+                logging.debug("Messages not modified")
+                self.response.status = '304 Not Modified'
+                return self.response
+
+        try:
+            (messages, cursor, more) = dao.get_messages(self.irssi_user, timestamp,
+                                                        self.data.get("pageSize", dao.DefaultMessagePageSize),
+                                                        self.data.get("cursor"))
+        except:
+            logging.warn("Invalid message query, exception %s", traceback.format_exc())
+            self.response.status = '400 Bad Request'
+            return self.response
+
+        if self.get_protocol() >= MessageObjectsProtocol:
+            # messages as objects, encoded once together with the response
+            response_json = json.dumps({"servermessage": serverMessage,
+                                        "messages": [message.to_json_dict() for message in messages],
+                                        "cursor": cursor, "more": more}, separators=(',', ':'))
+        else:
+            message_jsons = [message.to_json() for message in messages]
+            response_json = json.dumps({"servermessage": serverMessage, "messages": message_jsons,
+                                        "cursor": cursor, "more": more})
 
         self.response.out.write(response_json)
 
 
+class MessageBatchController(BaseController):
+    def post(self):
+        success = self.initController("MessageBatchController.post()", ["messages", "version"])
+        if not success:
+            return self.response
+
+        self.response.headers['Content-Type'] = 'application/json'
+        (cont, serverMessage) = getIrssiServerMessage(self.data)
+        if not cont:
+            self.response.out.write(json.dumps({'servermessage': serverMessage, 'results': []}))
+            return self.response
+
+        try:
+            batch = json.loads(self.data['messages'])
+            version = int(self.data['version'])
+        except ValueError:
+            logging.warn("Malformed message batch: %s" % traceback.format_exc())
+            self.response.status = '400 Bad Request'
+            return self.response
+
+        if not isinstance(batch, list) or len(batch) > MaxMessageBatchSize:
+            logging.warn("Message batch is not a list or is too large")
+            self.response.status = '400 Bad Request'
+            return self.response
+
+        results = []
+        valid = []
+        for item in batch:
+            if isinstance(item, dict) and self.validate_params(item, ["message", "channel", "nick"]):
+                results.append({'status': 'ok'})
+                valid.append(item)
+            else:
+                results.append({'status': 'error', 'error': 'missing fields'})
+
+        if len(valid) > 0 and not self.check_rate_limit(len(valid)):
+            return self.response
+
+        if len(valid) > 0:
+            try:
+                messages = dao.add_messages(self.irssi_user, valid)
+                dao.update_irssi_user_from_message(self.irssi_user, version, len(messages))
+                gcmhelper.send_gcm_messages_to_user_deferred(self.irssi_user, messages)
+            except:
+                logging.warn("Error while creating new messages, exception %s", traceback.format_exc())
+                self.response.status = '400 Bad Request'
+                return self.response
+
+        self.response.out.write(json.dumps({'servermessage': serverMessage, 'results': results}))
+
+
 class CommandController(BaseController):
     def post(self):
         success = self.initController("CommandController.post()", ["command"])
@@ -246,7 +412,8 @@ class CommandController(BaseController):
             return self.response
 
         try:
-            gcmhelper.send_gcm_to_user_deferred(self.irssi_user, json.dumps({"command": self.data['command']}))
+            gcmhelper.send_gcm_to_user_deferred(self.irssi_user, json.dumps({"command": self.data['command']}),
+                                                gcmhelper.TrafficCommand)
         except:
             self.response.status = '400 Bad Request'
             return self.response
@@ -281,6 +448,20 @@ class AdminController(BaseController):
         self.redirect('https://appengine.google.com/dashboard?&app_id=s~irssinotifier')
 
 
+class StatsController(webapp2.RequestHandler):
+    def get(self):
+        stats = {'instance_id': os.environ.get('INSTANCE_ID'),
+                 'api_token_cache': dao.get_api_token_cache_stats(),
+                 'gcm_token_cache': dao.gcm_token_cache.stats(),
+                 'gcm_pull_worker': gcmhelper.get_pull_worker_stats(),
+                 'gcm_circuit_breaker': gcmhelper.get_circuit_breaker_stats(),
+                 'message_expiry': dao.get_message_expiry_progress(),
+                 'wipe': dao.get_wipe_progress(self.request.get('wipe')) if self.request.get('wipe') else None,
+                 'queues': gcmhelper.get_queue_stats()}
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(json.dumps(stats))
+
+
 class AnalyticsController(BaseController):
     def get(self):
         self.redirect(
@@ -291,6 +472,29 @@ class CronController(webapp2.RequestHandler):
     def get(self):
         logging.info("Clearing data")
         dao.clear_old_messages()
+        deferred.defer(dao.clear_old_idempotency_records, _queue=dao.MessageExpiryQueueName)
+        deferred.defer(dao.clear_old_nonces, _queue=dao.MessageExpiryQueueName)
+
+
+class MessageMigrationController(webapp2.RequestHandler):
+    def get(self):
+        logging.info("Starting message migration")
+        deferred.defer(dao.migrate_messages)
+        self.response.out.write("Message migration started")
+
+
+class ApiTokenBackfillController(webapp2.RequestHandler):
+    def get(self):
+        logging.info("Starting api token backfill")
+        deferred.defer(dao.backfill_api_tokens)
+        self.response.out.write("Api token backfill started")
+
+
+class GcmTokenMigrationController(webapp2.RequestHandler):
+    def get(self):
+        logging.info("Starting GCM token migration")
+        deferred.defer(dao.migrate_gcm_tokens)
+        self.response.out.write("GCM token migration started")
 
 
 class NonceController(BaseController):
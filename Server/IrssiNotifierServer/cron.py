@@ -1,7 +1,11 @@
 import webapp2
 import logging
-from controllers import CronController
+from controllers import CronController, MessageMigrationController, ApiTokenBackfillController, \
+    GcmTokenMigrationController
 
-app = webapp2.WSGIApplication([('/cron/clear', CronController)], debug=True)
+app = webapp2.WSGIApplication([('/cron/clear', CronController),
+                               ('/cron/migrate_messages', MessageMigrationController),
+                               ('/cron/backfill_api_tokens', ApiTokenBackfillController),
+                               ('/cron/migrate_gcm_tokens', GcmTokenMigrationController)], debug=True)
 
 logging.debug("loaded cron")
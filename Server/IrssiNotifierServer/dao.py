@@ -1,25 +1,81 @@
+import hashlib
 import time
 import traceback
 import uuid
 from Crypto.Random import random
 from google.appengine.api import memcache
+from google.appengine.ext import deferred
 
 from datamodels import *
 from google.appengine.ext import ndb
+from lrucache import LruCache
 import yaml
 
 OldMessageRemovalThreshold = 7 * 24 * 60 * 60
+MaxPushCoalesceWindow = 5 * 60
+GcmTokenCacheTime = 60 * 60
+GcmTokenLocalCacheTime = 30
+# keeps concurrent readers from re-adding a stale token list right after an invalidation
+GcmTokenInvalidationLockTime = 5
+
+# tokens saved before GcmTokens were keyed by registration id are searched from the user's tokens until migrated
+LegacyGcmTokenLookup = True
+ApiTokenLocalCacheTime = 60
+# users created before the ApiToken kind existed are found with a query until backfill_api_tokens has run
+ApiTokenFallbackQuery = True
+NegativeApiTokenCacheTime = 10 * 60
+# cached in place of a user when no user has the api token, memcache.get returns None for misses
+NoIrssiUser = 'no-such-user'
+
+gcm_token_cache = LruCache(1000, GcmTokenLocalCacheTime)
+api_token_cache = LruCache(1000, ApiTokenLocalCacheTime)
+api_token_memcache_stats = {'hits': 0, 'misses': 0}
+NotificationCounterFlushInterval = 5 * 60
+# messages used to be stored as children of their IrssiUser, keep reading those until they are migrated or expired
+ReadLegacyMessages = True
+DefaultMessagePageSize = 50
+MaxMessagePageSize = 500
+# message queries are eventually consistent, a fresh version is not used for conditional requests until it settles
+MessageVersionSettleTime = 10
+# store message fields as raw bytes in Message.payload instead of base64 text, both are always readable
+CompactMessageStorage = False
+MessageExpiryBucketSize = 60 * 60
+MaxDeletePages = 20
+MessageExpiryQueueName = 'expiryqueue'
+MessageExpiryProgressKey = 'message-expiry'
+MaxWipePages = 20
+# a nonce is handed out for NonceExpirationTime and accepted for MaxNonceAge, then swept by the cron
+NonceExpirationTime = 20 * 60
+MaxNonceAge = 24 * 60 * 60
+LegacyNonceLookup = True
+# retried message posts with the same idempotency key get the original response within this window
+IdempotencyWindow = 24 * 60 * 60
+IdempotencyPendingTime = 60
+MaxIdempotencyKeyLength = 100
+IdempotencyPending = 'pending'
 
 
 # gcm token stuff
 
-def get_gcm_token_for_key(token_key):
-    return token_key.get()
+def get_gcm_token_for_id(irssi_user, token_key):
+    token = _gcm_token_key(irssi_user.key, token_key).get()
+    if token is None and LegacyGcmTokenLookup:
+        for legacy_token in GcmToken.query(ancestor=irssi_user.key):
+            if legacy_token.gcm_token == token_key:
+                return legacy_token
+    return token
 
 
-def get_gcm_token_for_id(irssi_user, token_key):
-    query = GcmToken.query(GcmToken.gcm_token == token_key, ancestor=irssi_user.key)
-    return query.get()
+def _gcm_token_key(irssi_user_key, gcm_token):
+    return ndb.Key(GcmToken, hashlib.sha1(gcm_token.encode('utf-8')).hexdigest(), parent=irssi_user_key)
+
+
+def _rekey_gcm_token(token, gcm_token):
+    return GcmToken(key=_gcm_token_key(token.key.parent(), gcm_token),
+                    gcm_token=gcm_token,
+                    enabled=token.enabled,
+                    name=token.name,
+                    registration_date=token.registration_date)
 
 
 def get_gcm_tokens_for_user(user):
@@ -27,6 +83,63 @@ def get_gcm_tokens_for_user(user):
 
 
 def get_gcm_tokens_for_user_key(irssi_user_key, include_disabled=False):
+    if include_disabled:
+        return _query_gcm_tokens(irssi_user_key, include_disabled)
+
+    cache_key = _gcm_tokens_cache_key(irssi_user_key)
+    tokensList = gcm_token_cache.get(cache_key)
+    if tokensList is not None:
+        return list(tokensList)
+
+    tokensList = memcache.get(cache_key)
+    if tokensList is None:
+        tokensList = _query_gcm_tokens(irssi_user_key, include_disabled)
+        memcache.add(cache_key, tokensList, time=GcmTokenCacheTime)
+
+    gcm_token_cache.set(cache_key, tokensList)
+    return list(tokensList)
+
+
+def get_gcm_tokens_for_user_keys(irssi_user_keys):
+    tokens = {}
+    missing = []
+    for user_key in irssi_user_keys:
+        tokensList = gcm_token_cache.get(_gcm_tokens_cache_key(user_key))
+        if tokensList is not None:
+            tokens[user_key] = list(tokensList)
+        else:
+            missing.append(user_key)
+
+    cached = memcache.get_multi([_gcm_tokens_cache_key(k) for k in missing])
+    query_user_keys = []
+    for user_key in missing:
+        cache_key = _gcm_tokens_cache_key(user_key)
+        if cached.get(cache_key) is not None:
+            gcm_token_cache.set(cache_key, cached[cache_key])
+            tokens[user_key] = list(cached[cache_key])
+        else:
+            query_user_keys.append(user_key)
+
+    # one keys only query per user, but all of the tokens are fetched with a single get_multi
+    futures = [GcmToken.query(GcmToken.enabled == True, ancestor=k).fetch_async(keys_only=True)  # must be ==
+               for k in query_user_keys]
+    token_keys = [f.get_result() for f in futures]
+    all_tokens = ndb.get_multi([k for keys in token_keys for k in keys])
+
+    to_cache = {}
+    index = 0
+    for user_key, keys in zip(query_user_keys, token_keys):
+        tokensList = all_tokens[index:index + len(keys)]
+        index += len(keys)
+        to_cache[_gcm_tokens_cache_key(user_key)] = tokensList
+        gcm_token_cache.set(_gcm_tokens_cache_key(user_key), tokensList)
+        tokens[user_key] = list(tokensList)
+    memcache.add_multi(to_cache, time=GcmTokenCacheTime)
+
+    return tokens
+
+
+def _query_gcm_tokens(irssi_user_key, include_disabled):
     query = GcmToken.query(ancestor=irssi_user_key)
     if not include_disabled:
         query = query.filter(GcmToken.enabled == True)  # must be ==
@@ -34,30 +147,129 @@ def get_gcm_tokens_for_user_key(irssi_user_key, include_disabled=False):
     return tokensList
 
 
+def _gcm_tokens_cache_key(irssi_user_key):
+    return "gcm-tokens-" + str(irssi_user_key.id())
+
+
+def invalidate_gcm_tokens(irssi_user_key):
+    cache_key = _gcm_tokens_cache_key(irssi_user_key)
+    gcm_token_cache.delete(cache_key)
+    memcache.delete(cache_key, seconds=GcmTokenInvalidationLockTime)
+
+
 def remove_gcm_token(token):
     token.key.delete()
+    invalidate_gcm_tokens(token.key.parent())
 
 
-def update_gcm_token(token, new_token_id):
-    token.gcm_token = new_token_id
-    token.put()
+def remove_gcm_tokens(tokens):
+    ndb.delete_multi([t.key for t in tokens])
+    for user_key in set([t.key.parent() for t in tokens]):
+        invalidate_gcm_tokens(user_key)
+
+
+def update_gcm_tokens(updates):
+    new_tokens = [_rekey_gcm_token(token, new_token_id) for token, new_token_id in updates]
+    # store the new tokens first so a failure cannot lose a device
+    ndb.put_multi(new_tokens)
+    ndb.delete_multi([token.key for token, _ in updates])
+    for user_key in set([token.key.parent() for token, _ in updates]):
+        invalidate_gcm_tokens(user_key)
+    return new_tokens
+
+
+def migrate_gcm_tokens(cursor=None):
+    MaxAmount = 500
+
+    query = GcmToken.query()
+    tokens, next_cursor, more = query.fetch_page(MaxAmount, start_cursor=cursor)
+
+    legacy = [t for t in tokens if t.key != _gcm_token_key(t.key.parent(), t.gcm_token)]
+    existing = ndb.get_multi([_gcm_token_key(t.key.parent(), t.gcm_token) for t in legacy])
+    migrated = [_rekey_gcm_token(t, t.gcm_token) for t, e in zip(legacy, existing) if e is None]
+    ndb.put_multi(migrated)
+    ndb.delete_multi([t.key for t in legacy])
+    for user_key in set([t.key.parent() for t in legacy]):
+        invalidate_gcm_tokens(user_key)
+    logging.info("Migrated %s GCM tokens, removed %s duplicates" % (len(migrated), len(legacy) - len(migrated)))
+
+    if more:
+        deferred.defer(migrate_gcm_tokens, next_cursor)
+    else:
+        logging.info("GCM token migration done")
 
 
 # irssi user stuff
 
 def get_irssi_user_for_api_token(token):
-    api_token_key = "api-token" + str(token)
-    user = memcache.get(api_token_key)
-    if user is not None:
-        return user
+    api_token_key = _api_token_cache_key(token)
+    user = api_token_cache.get(api_token_key)
+    if user is None:
+        user = memcache.get(api_token_key)
+        if user is not None:
+            api_token_memcache_stats['hits'] += 1
+            api_token_cache.set(api_token_key, user)
+        else:
+            api_token_memcache_stats['misses'] += 1
+            user = _load_irssi_user_for_api_token(token)
+            cache_irssi_user_for_api_token(token, user)
+
+    if not isinstance(user, IrssiUser):
+        return None
+    return user
 
-    query = IrssiUser.query(IrssiUser.api_token == token)
-    user = query.get()
 
-    memcache.set(api_token_key, user)
+def _load_irssi_user_for_api_token(token):
+    if not token or len(token) > 500:
+        return None
+
+    api_token = ApiToken.get_by_id(token)
+    if api_token is not None:
+        return api_token.user.get()
+
+    if not ApiTokenFallbackQuery:
+        return None
+
+    user = IrssiUser.query(IrssiUser.api_token == token).get()
+    if user is not None:
+        logging.info("Adding missing api token mapping for user %s" % user.key.id())
+        ApiToken(id=token, user=user.key).put()
     return user
 
 
+def backfill_api_tokens(cursor=None):
+    MaxAmount = 500
+
+    query = IrssiUser.query()
+    users, next_cursor, more = query.fetch_page(MaxAmount, start_cursor=cursor)
+    api_tokens = [ApiToken(id=u.api_token, user=u.key) for u in users if u.api_token]
+    ndb.put_multi(api_tokens)
+    logging.info("Backfilled %s api tokens" % len(api_tokens))
+
+    if more:
+        deferred.defer(backfill_api_tokens, next_cursor)
+    else:
+        logging.info("Api token backfill done")
+
+
+def _api_token_cache_key(token):
+    return "api-token" + str(token)
+
+
+def cache_irssi_user_for_api_token(token, irssi_user):
+    api_token_key = _api_token_cache_key(token)
+    if irssi_user is None:
+        memcache.set(api_token_key, NoIrssiUser, time=NegativeApiTokenCacheTime)
+        api_token_cache.set(api_token_key, NoIrssiUser)
+    else:
+        memcache.set(api_token_key, irssi_user)
+        api_token_cache.set(api_token_key, irssi_user)
+
+
+def get_api_token_cache_stats():
+    return {'local': api_token_cache.stats(), 'memcache': dict(api_token_memcache_stats)}
+
+
 def get_irssi_user_for_key_name(key_name):
     return IrssiUser.get_by_id(key_name)
 
@@ -73,39 +285,118 @@ def add_irssi_user(user, user_id=None):
     irssi_user.email = user.email()
     irssi_user.api_token = generate_api_token()
     irssi_user.registration_date = int(time.time())
-    irssi_user.put()
+    ndb.put_multi([irssi_user, ApiToken(id=irssi_user.api_token, user=irssi_user.key)])
 
-    api_token_key = "api-token" + str(irssi_user.api_token)
-    memcache.set(api_token_key, irssi_user)
+    cache_irssi_user_for_api_token(irssi_user.api_token, irssi_user)
 
     return irssi_user
 
 
-def update_irssi_user_from_message(irssi_user, version):
+def update_irssi_user_from_message(irssi_user, version, count=1):
+    return update_irssi_user_from_message_async(irssi_user, version, count).get_result()
+
+
+@ndb.tasklet
+def update_irssi_user_from_message_async(irssi_user, version, count=1):
     logging.debug("updating irssi user")
-    modified = False
     if irssi_user.license_timestamp is not None:
-        modified = True
-        irssi_user.last_notification_time = int(time.time())
-        if irssi_user.notification_count_since_licensed is None:
-            irssi_user.notification_count_since_licensed = 1
-        else:
-            irssi_user.notification_count_since_licensed += 1
+        yield increment_notification_counters_async(irssi_user, count)
 
-    if irssi_user.last_notification_time is None:
-        modified = True
-        irssi_user.last_notification_time = int(time.time())
+    if irssi_user.last_notification_time is None or irssi_user.irssi_script_version != version:
+        def update(user):
+            if user.last_notification_time is None:
+                user.last_notification_time = int(time.time())
+            user.irssi_script_version = version
 
-    if irssi_user.irssi_script_version != version:
-        modified = True
-        irssi_user.irssi_script_version = version
+        irssi_user = yield _update_irssi_user_async(irssi_user.key, update)
 
-    if modified:
-        irssi_user.put()
-        api_token_key = "api-token" + str(irssi_user.api_token)
-        memcache.set(api_token_key, irssi_user)
+    raise ndb.Return(irssi_user)
 
-    return irssi_user
+
+def _update_irssi_user(irssi_user_key, update):
+    return _update_irssi_user_async(irssi_user_key, update).get_result()
+
+
+@ndb.tasklet
+def _update_irssi_user_async(irssi_user_key, update):
+    # always modify a fresh copy, cached users may have stale notification counters
+    def txn():
+        user = irssi_user_key.get()
+        if user is None:
+            return None
+        update(user)
+        user.put()
+        return user
+
+    irssi_user = yield ndb.transaction_async(txn)
+    if irssi_user is not None and irssi_user.api_token:
+        api_token_key = _api_token_cache_key(irssi_user.api_token)
+        api_token_cache.set(api_token_key, irssi_user)
+        yield ndb.get_context().memcache_set(api_token_key, irssi_user)
+    raise ndb.Return(irssi_user)
+
+
+# notification counter stuff
+
+def _notification_count_key(irssi_user_key):
+    return "notification-count-" + str(irssi_user_key.id())
+
+
+def _notification_time_key(irssi_user_key):
+    return "notification-time-" + str(irssi_user_key.id())
+
+
+def _notification_flush_key(irssi_user_key):
+    return "notification-flush-" + str(irssi_user_key.id())
+
+
+@ndb.tasklet
+def increment_notification_counters_async(irssi_user, count=1):
+    ctx = ndb.get_context()
+    key = irssi_user.key
+    (_, _, flush_needed) = yield (ctx.memcache_incr(_notification_count_key(key), delta=count, initial_value=0),
+                                  ctx.memcache_set(_notification_time_key(key), int(time.time())),
+                                  ctx.memcache_add(_notification_flush_key(key), True,
+                                                   time=NotificationCounterFlushInterval))
+
+    if flush_needed:
+        logging.debug("Scheduling notification counter flush for user %s" % key.id())
+        deferred.defer(flush_notification_counters, key, _countdown=NotificationCounterFlushInterval)
+
+
+def get_pending_notification_counters(irssi_user_key):
+    count_key = _notification_count_key(irssi_user_key)
+    time_key = _notification_time_key(irssi_user_key)
+    values = memcache.get_multi([count_key, time_key])
+    count = int(values.get(count_key) or 0)
+    last_time = values.get(time_key)
+    return count, last_time
+
+
+def get_notification_stats(irssi_user):
+    count, last_time = get_pending_notification_counters(irssi_user.key)
+    if irssi_user.notification_count_since_licensed is not None:
+        count += irssi_user.notification_count_since_licensed
+    if last_time is None or (irssi_user.last_notification_time or 0) > last_time:
+        last_time = irssi_user.last_notification_time
+    return count, last_time
+
+
+def flush_notification_counters(irssi_user_key):
+    count, last_time = get_pending_notification_counters(irssi_user_key)
+    logging.info("Flushing notification counters for user %s: %s, %s" % (irssi_user_key.id(), count, last_time))
+    if count == 0 and last_time is None:
+        return
+
+    def update(user):
+        if count > 0:
+            user.notification_count_since_licensed = (user.notification_count_since_licensed or 0) + count
+        if last_time is not None and last_time > (user.last_notification_time or 0):
+            user.last_notification_time = last_time
+
+    _update_irssi_user(irssi_user_key, update)
+    if count > 0:
+        memcache.decr(_notification_count_key(irssi_user_key), delta=count)
 
 
 # gcm auth key stuff
@@ -131,122 +422,397 @@ def add_gcm_auth_key():
 
 # message stuff
 
-def get_messages(user, timestamp):
-    logging.debug("Getting messages after: %s" % timestamp)
-    query = Message.query(Message.server_timestamp > int(timestamp), ancestor=user.key).order(Message.server_timestamp)
-
-    m = query.fetch(50)
+def get_messages(user, timestamp, page_size=DefaultMessagePageSize, continuation=None):
+    """Returns (messages, continuation, more). The continuation is an opaque token for fetching the next page."""
+    if continuation is not None:
+        (timestamp, cursor) = continuation.split('-', 1)
+        cursor = ndb.Cursor(urlsafe=cursor)
+    else:
+        cursor = None
+    timestamp = int(timestamp)
+    page_size = max(1, min(int(page_size), MaxMessagePageSize))
+
+    logging.debug("Getting %s messages after: %s" % (page_size, timestamp))
+    # the key breaks ties between messages of the same second so that none are skipped between pages
+    query = Message.query(Message.owner == user.key, Message.server_timestamp > timestamp).order(
+        Message.server_timestamp, Message.key)
+    future = query.fetch_page_async(page_size, start_cursor=cursor)
+
+    legacy_future = None
+    if ReadLegacyMessages and cursor is None:
+        legacy_query = Message.query(Message.server_timestamp > timestamp, ancestor=user.key).order(Message.server_timestamp)
+        legacy_future = legacy_query.fetch_async(page_size)
+
+    (m, next_cursor, more) = future.get_result()
+    legacy = legacy_future.get_result() if legacy_future is not None else []
+    if len(legacy) > 0:
+        # a cursor would skip the legacy messages after this page, page by timestamp until they are migrated
+        merged = sorted(m + legacy, key=lambda msg: msg.server_timestamp)
+        more = more or len(legacy) == page_size or len(merged) > page_size
+        m = merged[:page_size]
+        next_cursor = None
     logging.debug("Found %s messages" % len(m))
-    return m
+
+    next_continuation = None
+    if next_cursor is not None:
+        next_continuation = "%s-%s" % (timestamp, next_cursor.urlsafe())
+    return m, next_continuation, more
+
+
+def _message_version_key(irssi_user_key):
+    return "message-version-" + str(irssi_user_key.id())
+
+
+def _new_message_version():
+    return uuid.uuid4().hex, int(time.time())
+
+
+def get_message_version(irssi_user):
+    """Returns (version, timestamp), the version changes whenever messages of the user are added or removed."""
+    key = _message_version_key(irssi_user.key)
+    version = memcache.get(key)
+    if version is None:
+        version = _new_message_version()
+        if not memcache.add(key, version):
+            version = memcache.get(key) or version
+    return version
+
+
+def bump_message_version(irssi_user_key):
+    memcache.set(_message_version_key(irssi_user_key), _new_message_version())
+
+
+@ndb.tasklet
+def bump_message_version_async(irssi_user_key):
+    yield ndb.get_context().memcache_set(_message_version_key(irssi_user_key), _new_message_version())
 
 
 def add_message(irssi_user, message=None, channel=None, nick=None):
-    msg = Message(parent=irssi_user.key)
-    msg.message = message
-    msg.channel = channel
-    msg.nick = nick
+    return add_message_async(irssi_user, message, channel, nick).get_result()
+
+
+@ndb.tasklet
+def add_message_async(irssi_user, message=None, channel=None, nick=None):
+    msg = Message(owner=irssi_user.key)
+    msg.set_fields(message, channel, nick, CompactMessageStorage)
     msg.server_timestamp = int(time.time())
     if irssi_user.license_timestamp is not None:
         logging.debug("Licensed user, saving message")
-        msg.put()
+        yield msg.put_async()
+        yield bump_message_version_async(irssi_user.key)
     else:
         logging.debug("Free user, not saving message")
-    return msg
+    raise ndb.Return(msg)
+
+
+def add_messages(irssi_user, messages):
+    server_timestamp = int(time.time())
+    msgs = []
+    for m in messages:
+        msg = Message(owner=irssi_user.key)
+        msg.set_fields(m['message'], m['channel'], m['nick'], CompactMessageStorage)
+        msg.server_timestamp = server_timestamp
+        msgs.append(msg)
+
+    if irssi_user.license_timestamp is not None:
+        logging.debug("Licensed user, saving %s messages" % len(msgs))
+        ndb.put_multi(msgs)
+        bump_message_version(irssi_user.key)
+    else:
+        logging.debug("Free user, not saving %s messages" % len(msgs))
+    return msgs
+
+
+def migrate_messages(cursor=None):
+    MaxAmount = 500
+
+    query = Message.query()
+    messages, next_cursor, more = query.fetch_page(MaxAmount, start_cursor=cursor)
+
+    legacy = [m for m in messages if m.key.parent() is not None]
+    migrated = [Message(owner=m.key.parent(),
+                        server_timestamp=m.server_timestamp,
+                        message=m.message,
+                        channel=m.channel,
+                        nick=m.nick) for m in legacy]
+    ndb.put_multi(migrated)
+    ndb.delete_multi([m.key for m in legacy])
+    logging.info("Migrated %s messages" % len(migrated))
+
+    if more:
+        deferred.defer(migrate_messages, next_cursor)
+    else:
+        logging.info("Message migration done")
 
 
 def clear_old_messages():
+    cutoff = int(time.time()) - OldMessageRemovalThreshold
+    oldest = Message.query().order(Message.server_timestamp).get(projection=[Message.server_timestamp])
+    if oldest is None or oldest.server_timestamp >= cutoff:
+        logging.info("No old messages to clear")
+        return
+
+    # one task per hour of messages, so the work does not depend on how many users there are
+    start = oldest.server_timestamp - oldest.server_timestamp % MessageExpiryBucketSize
+    buckets = range(start, cutoff, MessageExpiryBucketSize)
+    logging.info("Clearing messages older than %s in %s buckets" % (cutoff, len(buckets)))
+    memcache.set(MessageExpiryProgressKey, {'started': int(time.time()), 'cutoff': cutoff, 'buckets': len(buckets)})
+    memcache.set_multi({'deleted': 0, 'buckets_done': 0}, key_prefix=MessageExpiryProgressKey + '-')
+    for bucket_start in buckets:
+        deferred.defer(clear_messages_in_range, bucket_start, min(bucket_start + MessageExpiryBucketSize, cutoff),
+                       _queue=MessageExpiryQueueName)
+
+
+def _delete_query_pages(query, cursor=None):
+    """Deletes up to MaxDeletePages pages of the query, returns (deleted, cursor, more) for continuing."""
     MaxAmount = 500
-    amount = MaxAmount
 
-    logging.info("Clearing old messages")
-    while amount == MaxAmount:
-        query = Message.query(Message.server_timestamp < (int(time.time()) - OldMessageRemovalThreshold))
-        keys = query.fetch(MaxAmount, keys_only=True)
-        ndb.delete_multi(keys)
-        amount = len(keys)
-        logging.info("Deleted %s messages" % amount)
+    delete_futures = []
+    deleted = 0
+    more = True
+    pages = 0
+    while more and pages < MaxDeletePages:
+        keys, cursor, more = query.fetch_page(MaxAmount, start_cursor=cursor, keys_only=True)
+        # the next page is fetched while this one is being deleted
+        delete_futures.extend(ndb.delete_multi_async(keys))
+        deleted += len(keys)
+        pages += 1
+    ndb.Future.wait_all(delete_futures)
+    return deleted, cursor, more
+
+
+def clear_messages_in_range(start, end, cursor=None):
+    query = Message.query(Message.server_timestamp >= start, Message.server_timestamp < end)
+    (deleted, cursor, more) = _delete_query_pages(query, cursor)
+
+    logging.info("Deleted %s messages between %s and %s" % (deleted, start, end))
+    memcache.offset_multi({'deleted': deleted, 'buckets_done': 0 if more else 1},
+                          key_prefix=MessageExpiryProgressKey + '-', initial_value=0)
+    if more:
+        # checkpoint, the rest of the bucket continues in a new task
+        deferred.defer(clear_messages_in_range, start, end, cursor, _queue=MessageExpiryQueueName)
+
+
+def get_message_expiry_progress():
+    progress = memcache.get(MessageExpiryProgressKey)
+    if progress is None:
+        return None
+    counters = memcache.get_multi(['deleted', 'buckets_done'], key_prefix=MessageExpiryProgressKey + '-')
+    progress['deleted'] = int(counters.get('deleted') or 0)
+    progress['buckets_done'] = int(counters.get('buckets_done') or 0)
+    return progress
 
 
 # settings stuff
 
 def save_settings(user, token_id, enabled, name):
+    # not a blind put: the read keeps registration_date and finds legacy entities, it is a key get unless
+    # LegacyGcmTokenLookup is on
     token = get_gcm_token_for_id(user, token_id)
+    if token is not None and token.key == _gcm_token_key(user.key, token_id) and \
+            token.enabled == enabled and token.name == name:
+        logging.debug("Token settings unchanged: " + token_id)
+        return token
 
+    tokenToSave = GcmToken(key=_gcm_token_key(user.key, token_id))
+    tokenToSave.gcm_token = token_id
+    tokenToSave.enabled = enabled
+    tokenToSave.name = name
     if token is not None:
         logging.debug("Updating token: " + token_id)
-        token.enabled = enabled
-        token.name = name
-        token.put()
-        return token
+        tokenToSave.registration_date = token.registration_date
+    else:
+        logging.debug("Adding new token: " + token_id)
+        tokenToSave.registration_date = int(time.time())
+    tokenToSave.put()
+
+    if token is not None and token.key != tokenToSave.key:
+        logging.debug("Removing legacy token entity")
+        token.key.delete()
+
+    invalidate_gcm_tokens(user.key)
+    return tokenToSave
+
 
-    logging.debug("Adding new token: " + token_id)
-    tokenToAdd = GcmToken(parent=user.key)
-    tokenToAdd.gcm_token = token_id
-    tokenToAdd.enabled = enabled
-    tokenToAdd.name = name
-    tokenToAdd.registration_date = int(time.time())
-    tokenToAdd.put()
-    return tokenToAdd
+def save_push_coalesce_window(irssi_user, window):
+    window = max(0, min(window, MaxPushCoalesceWindow))
+    logging.debug("Setting push coalesce window to %s" % window)
+
+    def update(user):
+        user.push_coalesce_window = window
+
+    return _update_irssi_user(irssi_user.key, update)
 
 
 def wipe_user(user):
     logging.info("Wiping everything for user %s" % user.user_id)
+    revoke_api_token(user)
+    memcache.set(_wipe_progress_key(user.key), {'started': int(time.time()), 'deleted': 0, 'done': False})
+    deferred.defer(wipe_user_data, user.key)
+
+
+def revoke_api_token(user):
+    # the api token stops working right away, the data is wiped in the background
+    if user.api_token:
+        ndb.Key(ApiToken, user.api_token).delete()
+        cache_irssi_user_for_api_token(user.api_token, None)
 
-    key = user.key
+    def revoke(u):
+        u.api_token = None
+        u.wiping = True  # login treats the user as gone until wipe_user_data has deleted it
+    _update_irssi_user(user.key, revoke)
+
+
+def _wipe_progress_key(irssi_user_key):
+    return "wipe-progress-" + str(irssi_user_key.id())
+
+
+def wipe_user_data(irssi_user_key, cursors=None):
     MaxAmount = 500
 
-    api_token_key = "api-token" + str(user.api_token)
-    memcache.delete(api_token_key)
+    # the kindless ancestor query covers legacy messages, gcm tokens, nonces and licenses
+    queries = {'messages': Message.query(Message.owner == irssi_user_key),
+               'children': ndb.Query(ancestor=irssi_user_key)}
+    if cursors is None:
+        cursors = dict((name, None) for name in queries)
 
-    amount = MaxAmount
-    logging.info("Wiping messages")
-    while amount == MaxAmount:
-        query = Message.query(ancestor=key)
-        keys = query.fetch(MaxAmount, keys_only=True)
-        ndb.delete_multi(keys)
-        amount = len(keys)
-        logging.info("Deleted %s messages" % amount)
+    progress = memcache.get(_wipe_progress_key(irssi_user_key)) or {'deleted': 0}
+    delete_futures = []
+    pages = 0
+    while len(cursors) > 0 and pages < MaxWipePages:
+        page_futures = dict((name, queries[name].fetch_page_async(MaxAmount, start_cursor=cursor, keys_only=True))
+                            for name, cursor in cursors.items())
+        for name, future in page_futures.items():
+            (keys, cursor, more) = future.get_result()
+            keys = [k for k in keys if k != irssi_user_key]
+            delete_futures.extend(ndb.delete_multi_async(keys))
+            progress['deleted'] += len(keys)
+            if more:
+                cursors[name] = cursor
+            else:
+                del cursors[name]
+        pages += 1
+    ndb.Future.wait_all(delete_futures)
 
-    amount = MaxAmount
-    logging.info("Wiping GCM tokens")
-    while amount == MaxAmount:
-        query = GcmToken.query(ancestor=key)
-        keys = query.fetch(MaxAmount, keys_only=True)
-        ndb.delete_multi(keys)
-        amount = len(keys)
-        logging.info("Deleted %s tokens" % amount)
+    logging.info("Wiped %s entities of user %s so far" % (progress['deleted'], irssi_user_key.id()))
+    if len(cursors) > 0:
+        memcache.set(_wipe_progress_key(irssi_user_key), progress)
+        deferred.defer(wipe_user_data, irssi_user_key, cursors)
+        return
 
-    logging.info("Wiping user")
-    user.key.delete()
+    bump_message_version(irssi_user_key)
+    invalidate_gcm_tokens(irssi_user_key)
 
+    irssi_user_key.delete()
 
-def get_new_nonce(user):
-    query = Nonce.query(ancestor=user.key).order(-Nonce.issue_timestamp)
-    nonce = query.get()
+    progress['done'] = True
+    memcache.set(_wipe_progress_key(irssi_user_key), progress)
+    logging.info("Wiped user %s" % irssi_user_key.id())
+
+
+def get_wipe_progress(irssi_user_id):
+    return memcache.get(_wipe_progress_key(ndb.Key(IrssiUser, irssi_user_id)))
+
+
+# idempotency stuff
+
+def _idempotency_record_id(irssi_user, idempotency_key):
+    return "%s:%s" % (irssi_user.key.id(), idempotency_key)
+
+
+def _idempotency_cache_key(irssi_user, idempotency_key):
+    return "idempotency-" + _idempotency_record_id(irssi_user, idempotency_key)
+
+
+def begin_idempotent_request(irssi_user, idempotency_key):
+    """Returns (True, None) if the request should be processed, (False, response) for an already processed one
+    and (False, None) while another request with the same key is still being processed."""
+    cache_key = _idempotency_cache_key(irssi_user, idempotency_key)
+    if not memcache.add(cache_key, IdempotencyPending, time=IdempotencyPendingTime):
+        response = memcache.get(cache_key)
+        if response is not None:
+            return False, response if response != IdempotencyPending else None
+
+    # memcache might have lost the key, the datastore record is authoritative
+    record = IdempotencyRecord.get_by_id(_idempotency_record_id(irssi_user, idempotency_key))
+    if record is not None and record.timestamp > int(time.time()) - IdempotencyWindow:
+        memcache.set(cache_key, record.response, time=IdempotencyWindow)
+        return False, record.response
+    return True, None
+
+
+def finish_idempotent_request(irssi_user, idempotency_key, response):
+    record = IdempotencyRecord(id=_idempotency_record_id(irssi_user, idempotency_key))
+    record.response = response
+    record.timestamp = int(time.time())
+    record.put()
+    memcache.set(_idempotency_cache_key(irssi_user, idempotency_key), response, time=IdempotencyWindow)
+
+
+def abort_idempotent_request(irssi_user, idempotency_key):
+    memcache.delete(_idempotency_cache_key(irssi_user, idempotency_key))
 
-    nonce_expiration_time = 20 * 60
 
-    if nonce is not None and nonce.issue_timestamp + nonce_expiration_time > time.time():
-        logging.debug("Returning old nonce, issue_timestamp: %s" % nonce.issue_timestamp)
-        return nonce
+def clear_old_idempotency_records(cutoff=None, cursor=None):
+    if cutoff is None:
+        cutoff = int(time.time()) - IdempotencyWindow
+
+    query = IdempotencyRecord.query(IdempotencyRecord.timestamp < cutoff)
+    (deleted, cursor, more) = _delete_query_pages(query, cursor)
+    logging.info("Deleted %s idempotency records older than %s" % (deleted, cutoff))
+    if more:
+        deferred.defer(clear_old_idempotency_records, cutoff, cursor, _queue=MessageExpiryQueueName)
+
+
+def _live_nonce_key(irssi_user_key):
+    return "nonce-" + str(irssi_user_key.id())
+
+
+def get_new_nonce(user):
+    cached = memcache.get(_live_nonce_key(user.key))
+    if cached is not None:
+        (rand, issue_timestamp) = cached
+        logging.debug("Returning old nonce, issue_timestamp: %s" % issue_timestamp)
+        return Nonce(id=str(rand), parent=user.key, nonce=rand, issue_timestamp=issue_timestamp)
 
     rand = random.randint(-2147483648, 2147483647)
-    if nonce is None:
-        logging.debug("Old nonce doesn't exist, generating new one: %s." % rand)
-    else:
-        logging.debug("Old nonce is too old, generating new one: %s. Old: %s, now: %s" % (rand, nonce, int(time.time())))
+    logging.debug("No live nonce, generating new one: %s." % rand)
 
-    nonce = Nonce(parent=user.key)
+    nonce = Nonce(id=str(rand), parent=user.key)
     nonce.issue_timestamp = int(time.time())
     nonce.nonce = rand
     nonce.put()
+    memcache.set(_live_nonce_key(user.key), (rand, nonce.issue_timestamp), time=NonceExpirationTime)
 
     return nonce
 
 
 def get_nonce(user, nonce):
-    query = Nonce.query(Nonce.nonce == nonce, ancestor=user.key)
-    return query.get()
+    n = Nonce.get_by_id(str(nonce), parent=user.key)
+    if n is None and LegacyNonceLookup:
+        n = Nonce.query(Nonce.nonce == nonce, ancestor=user.key).get()
+    if n is None or n.issue_timestamp < int(time.time()) - MaxNonceAge:
+        return None
+    return n
+
+
+def remove_nonce(user, nonce):
+    # a nonce is used only once, the next license check gets a new one
+    cached = memcache.get(_live_nonce_key(user.key))
+    if cached is not None and cached[0] == nonce.nonce:
+        memcache.delete(_live_nonce_key(user.key))
+    nonce.key.delete()
+
+
+def clear_old_nonces(cutoff=None, cursor=None):
+    if cutoff is None:
+        cutoff = int(time.time()) - MaxNonceAge
+
+    query = Nonce.query(Nonce.issue_timestamp < cutoff)
+    (deleted, cursor, more) = _delete_query_pages(query, cursor)
+    logging.info("Deleted %s nonces older than %s" % (deleted, cutoff))
+    if more:
+        deferred.defer(clear_old_nonces, cutoff, cursor, _queue=MessageExpiryQueueName)
 
 
 def load_licensing_public_key():
@@ -278,16 +844,26 @@ def get_secret(secret_name):
         return None
 
 
+def _license_id(package_name, user_id):
+    return "%s:%s" % (package_name, user_id)
+
+
+def get_license(irssi_user, package_name, user_id):
+    return License.get_by_id(_license_id(package_name, user_id), parent=irssi_user.key)
+
+
 def save_license(irssi_user, response_code, nonce, package_name, version_code, user_id, timestamp, extra_data):
     logging.info("User %s licensed!" % irssi_user.email)
 
     current_time = int(time.time())
-    irssi_user.license_timestamp = current_time
-    irssi_user.put()
-    api_token_key = "api-token" + str(irssi_user.api_token)
-    memcache.set(api_token_key, irssi_user)
 
-    l = License(parent=irssi_user.key)
+    def update(user):
+        user.license_timestamp = current_time
+
+    irssi_user = _update_irssi_user(irssi_user.key, update)
+
+    # one record per Play account and package, a new license check replaces it instead of adding a row
+    l = License(id=_license_id(package_name, user_id), parent=irssi_user.key)
     l.response_code = response_code
     l.nonce = nonce
     l.package_name = package_name
@@ -1,6 +1,7 @@
 import json
 import logging
 from google.appengine.ext import ndb
+import messagecodec
 
 
 class Secret(ndb.Model):
@@ -17,10 +18,18 @@ class IrssiUser(ndb.Model):
     last_notification_time = ndb.IntegerProperty(indexed=False)
     irssi_script_version = ndb.IntegerProperty(indexed=False)
     license_timestamp = ndb.IntegerProperty(indexed=False)
+    push_coalesce_window = ndb.IntegerProperty(indexed=False)
+    wiping = ndb.BooleanProperty(indexed=False)
+
+
+class ApiToken(ndb.Model):
+    # keyed by the api token itself
+    user = ndb.KeyProperty(indexed=False)
 
 
 class GcmToken(ndb.Model):
-    gcm_token = ndb.StringProperty(indexed=True)
+    # keyed by a hash of gcm_token
+    gcm_token = ndb.StringProperty(indexed=False)
     enabled = ndb.BooleanProperty(indexed=True)
     name = ndb.StringProperty(indexed=False)
     registration_date = ndb.IntegerProperty(indexed=False)
@@ -30,25 +39,45 @@ class Message(ndb.Model):
     _use_memcache = False
     _use_cache = False
 
+    owner = ndb.KeyProperty(indexed=True)
     server_timestamp = ndb.IntegerProperty(indexed=True)
     message = ndb.TextProperty(indexed=False)
     channel = ndb.TextProperty(indexed=False)
     nick = ndb.TextProperty(indexed=False)
+    # message, channel and nick packed by messagecodec, used instead of the text properties when set
+    payload = ndb.BlobProperty(indexed=False)
+
+    def get_id(self):
+        return self.key.integer_id() if self.key is not None else None
+
+    def set_fields(self, message, channel, nick, compact=False):
+        if compact:
+            self.payload = messagecodec.encode_fields([message, channel, nick])
+            self.message = self.channel = self.nick = None
+        else:
+            self.payload = None
+            self.message = message
+            self.channel = channel
+            self.nick = nick
+
+    def get_fields(self):
+        if self.payload is not None:
+            return messagecodec.decode_fields(self.payload)
+        return self.message, self.channel, self.nick
+
+    def to_json_dict(self):
+        (message, channel, nick) = self.get_fields()
+        return {'server_timestamp': '%f' % self.server_timestamp,
+                'message': message,
+                'channel': channel,
+                'nick': nick,
+                'id': self.get_id()}
 
     def to_json(self):
-        return json.dumps(
-            {'server_timestamp': '%f' % self.server_timestamp,
-             'message': self.message,
-             'channel': self.channel,
-             'nick': self.nick,
-             'id': self.key.integer_id()})
+        return json.dumps(self.to_json_dict())
 
     def to_gcm_json(self):
-        values = {'server_timestamp': '%f' % self.server_timestamp,
-                  'message': self.message,
-                  'channel': self.channel,
-                  'nick': self.nick,
-                  'id': self.key.integer_id()}
+        values = self.to_json_dict()
         #if self.key.integer_id() is not None:
         #    values['id'] = self.key.integer_id() #this breaks free apps prior to version 13
         m = json.dumps(values)
@@ -60,12 +89,20 @@ class Message(ndb.Model):
         return json.dumps(values)
 
 
+class IdempotencyRecord(ndb.Model):
+    # keyed by "<irssi user id>:<idempotency key>"
+    response = ndb.TextProperty(indexed=False)
+    timestamp = ndb.IntegerProperty(indexed=True)
+
+
 class Nonce(ndb.Model):
+    # keyed by str(nonce) under the user
     nonce = ndb.IntegerProperty()
     issue_timestamp = ndb.IntegerProperty()
 
 
 class License(ndb.Model):
+    # keyed by "<package name>:<Play user id>" under the user
     response_code = ndb.IntegerProperty(indexed=False)
     nonce = ndb.IntegerProperty(indexed=False)
     package_name = ndb.TextProperty(indexed=False)
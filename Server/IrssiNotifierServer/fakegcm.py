@@ -0,0 +1,112 @@
+"""A local stand-in for the GCM HTTP endpoint, for tests and benchmarks that must run offline.
+
+The result for each registration id is chosen by the id itself:
+    canonical:<new id>  success with a canonical registration id
+    unavailable         Unavailable error
+    notregistered       NotRegistered error
+    invalid             InvalidRegistration error
+    anything else       success
+
+Failures and slowness for the whole server are set through the status and delay attributes.
+
+Usage: python fakegcm.py [port]
+"""
+
+import BaseHTTPServer
+import SocketServer
+import json
+import sys
+import threading
+import time
+
+ErrorResults = {'unavailable': 'Unavailable',
+                'notregistered': 'NotRegistered',
+                'invalid': 'InvalidRegistration'}
+
+
+class FakeGcmHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    timeout = 5  # drop idle keep-alive connections
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        server.record_request(self.client_address, self.headers.getheader('Authorization'), body)
+
+        if server.delay > 0:
+            time.sleep(server.delay)
+
+        if server.status != 200:
+            self.send_body(server.status, 'fake failure')
+            return
+
+        request = json.loads(body)
+        results = [self.get_result(registration_id) for registration_id in request['registration_ids']]
+        response = {'multicast_id': 1,
+                    'success': len([r for r in results if 'message_id' in r]),
+                    'failure': len([r for r in results if 'error' in r]),
+                    'canonical_ids': len([r for r in results if 'registration_id' in r]),
+                    'results': results}
+        self.send_body(200, json.dumps(response), 'application/json')
+
+    def get_result(self, registration_id):
+        self.server.message_id += 1
+        if registration_id in ErrorResults:
+            return {'error': ErrorResults[registration_id]}
+        if registration_id.startswith('canonical:'):
+            return {'message_id': str(self.server.message_id), 'registration_id': registration_id[len('canonical:'):]}
+        return {'message_id': str(self.server.message_id)}
+
+    def send_body(self, status, body, content_type='text/plain'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeGcmServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = False
+
+    def __init__(self, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), FakeGcmHandler)
+        self.status = 200
+        self.delay = 0
+        self.message_id = 0
+        self.requests = []
+        self.client_addresses = set()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s/gcm/send' % self.server_address[1]
+
+    def record_request(self, client_address, authorization, body):
+        with self.lock:
+            self.client_addresses.add(client_address)
+            self.requests.append((authorization, body))
+
+    def handle_error(self, request, client_address):
+        pass  # clients that time out close their connection before the delayed response is written
+
+    def connection_count(self):
+        return len(self.client_addresses)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    server = FakeGcmServer(int(sys.argv[1]) if len(sys.argv) > 1 else 8089)
+    print 'Fake GCM listening on %s' % server.url
+    server.serve_forever()
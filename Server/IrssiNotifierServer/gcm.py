@@ -1,12 +1,14 @@
-import socket
+import os
+import time
 import traceback
-import urllib2
 import logging
 from httplib import HTTPException
-from urllib2 import HTTPError
+from gcmtransport import HttpTransport, UrlfetchTransport, TransportError
 import json
 
 GcmUrl = "https://android.googleapis.com/gcm/send"
+# kept-alive socket connections need the Sockets API, which only billing-enabled apps have, see app.yaml
+UseSocketTransport = os.environ.get('GAE_USE_SOCKETS_HTTPLIB') is not None
 
 
 def is_set(key, arr):
@@ -15,37 +17,72 @@ def is_set(key, arr):
 
 class GCM(object):
     authkey = None
+    # shared by all instances so that connections to GCM are reused between tasks
+    default_transport = HttpTransport() if UseSocketTransport else UrlfetchTransport()
+    # shared by all instances through memcache, set up by gcmhelper
+    circuit_breaker = None
 
-    def __init__(self, dao, gcmhelper):
+    def __init__(self, dao, gcmhelper, transport=None, url=GcmUrl):
         self.tokens = []
         self.dao = dao
         self.gcmhelper = gcmhelper
+        self.transport = transport if transport is not None else GCM.default_transport
+        self.url = url
+        self.retry_attempt = 0
+        self.reset_gcm_results()
         if GCM.authkey is None:
             GCM.authkey = self.dao.load_gcm_auth_key()
             if GCM.authkey is None:
                 raise Exception("No auth key for GCM!")
 
-    def send_gcm_to_user(self, irssiuser_key, message):
+    @property
+    def tokens(self):
+        return self._tokens
+
+    @tokens.setter
+    def tokens(self, tokens):
+        self._tokens = tokens
+        self.token_ids = set([t.gcm_token for t in tokens])
+
+    def send_gcm_to_user(self, irssiuser_key, message, collapse_key=None):
         logging.debug("Sending gcm message to user %s" % irssiuser_key)
         if GCM.authkey is None:
             logging.error("No auth key for GCM!")
             return
 
         tokens = self.dao.get_gcm_tokens_for_user_key(irssiuser_key)
-        self.send_gcm(tokens, message)
+        self.send_gcm(tokens, message, collapse_key)
+
+    def send_gcm_messages_to_user(self, irssiuser_key, messages):
+        logging.debug("Sending %s gcm messages to user %s" % (len(messages), irssiuser_key))
+        if GCM.authkey is None:
+            logging.error("No auth key for GCM!")
+            return
+
+        tokens = self.dao.get_gcm_tokens_for_user_key(irssiuser_key)
+        for message in messages:
+            self.send_gcm(tokens, message)
+
+    def send_gcm(self, tokens, message, collapse_key=None):
+        request = self.send_gcm_async(tokens, message, collapse_key)
+        if request is not None:
+            self.handle_gcm_response(request, message)
 
-    def send_gcm(self, tokens, message):
+    def send_gcm_async(self, tokens, message, collapse_key=None):
         self.tokens = tokens
         logging.info("Sending gcm message to %s tokens" % len(self.tokens))
         if GCM.authkey is None:
             logging.error("No auth key for GCM!")
-            return
+            return None
 
         if len(self.tokens) == 0:
             logging.info("No tokens, stop sending")
-            return
+            return None
+
+        return self.send_request_async(message, self.tokens, collapse_key)
 
-        response_json = self.send_request(message, self.tokens)
+    def handle_gcm_response(self, request, message):
+        response_json = self.get_response(request)
         if response_json is None:
             return  # instant failure
 
@@ -58,42 +95,63 @@ class GCM(object):
             index += 1
             token = self.tokens[index]
             self.handle_gcm_result(result, token, message)
+        self.apply_gcm_results(message)
+
+    def send_request(self, message, tokens, collapse_key=None):
+        return self.get_response(self.send_request_async(message, tokens, collapse_key))
 
-    def send_request(self, message, tokens):
-        request = urllib2.Request(GcmUrl)
-        request.add_header('Authorization', 'key=%s' % GCM.authkey)
-        request.add_header('Content-Type', 'application/json')
+    def send_request_async(self, message, tokens, collapse_key=None):
+        headers = {'Authorization': 'key=%s' % GCM.authkey,
+                   'Content-Type': 'application/json'}
 
         json_request = {'data': {'message': message}, 'registration_ids': []}
+        if collapse_key is not None:
+            json_request['collapse_key'] = collapse_key
         for token in tokens:
             json_request['registration_ids'].append(token.gcm_token)
 
-        request.add_data(json.dumps(json_request))
+        if GCM.circuit_breaker is not None:
+            GCM.circuit_breaker.before_request()
 
-        response_body = ''
+        start_time = time.time()
+        request = self.transport.post_async(self.url, headers, json.dumps(json_request))
+        request.start_time = start_time
+        return request
 
+    def record_request(self, request, success):
+        if GCM.circuit_breaker is not None:
+            GCM.circuit_breaker.record(success, time.time() - request.start_time)
+
+    def get_response(self, request):
         try:
-            response = urllib2.urlopen(request)
-            response_body = response.read()
-            logging.debug("GCM Message sent, response: %s" % response_body)
-            return json.loads(response_body)
-        except HTTPError as e:
-            if 500 <= e.code < 600:
-                raise Exception("NOMAIL %s, retrying whole task" % e.code)  # retry
-            else:
-                logging.error(
-                    "Unable to send GCM message! Response code: %s, response body: %s " % (e.code, response_body))
-                return None  # do not retry
-        except HTTPException as e:
-            logging.warn("HTTPException: Unable to send GCM message! %s" % traceback.format_exc())
-            raise HTTPException("NOMAIL %s " % e)  # retry
-        except socket.error as e:
-            logging.warn("socket.error: Unable to send GCM message! %s" % traceback.format_exc())
+            (status, response_body) = request.get_result()
+        except TransportError as e:
+            self.record_request(request, False)
+            logging.warn("TransportError: Unable to send GCM message! %s" % traceback.format_exc())
             raise HTTPException("NOMAIL %s " % e)  # retry
         except:
             logging.error("Unable to send GCM message! %s" % traceback.format_exc())
             return None
 
+        self.record_request(request, status < 500)
+        if 500 <= status < 600:
+            raise Exception("NOMAIL %s, retrying whole task" % status)  # retry
+        if status != 200:
+            logging.error("Unable to send GCM message! Response code: %s, response body: %s " % (status, response_body))
+            return None  # do not retry
+
+        logging.debug("GCM Message sent, response: %s" % response_body)
+        try:
+            return json.loads(response_body)
+        except ValueError:
+            logging.error("Unable to parse GCM response! %s" % response_body)
+            return None
+
+    def reset_gcm_results(self):
+        self.tokens_to_remove = []
+        self.tokens_to_update = []
+        self.tokens_to_retry = []
+
     def handle_gcm_result(self, result, token, message):
         if is_set("message_id", result):
             if is_set("registration_id", result):
@@ -105,13 +163,13 @@ class GCM(object):
                 logging.warn("Error sending GCM message: %s" % error)
                 if error == "Unavailable":
                     logging.warn("Token unavailable, retrying")
-                    self.gcmhelper.send_gcm_to_token_deferred(token, message)
+                    self.tokens_to_retry.append(token)
                 elif error == "NotRegistered":
                     logging.warn("Token not registered, deleting token")
-                    self.dao.remove_gcm_token(token)
+                    self.tokens_to_remove.append(token)
                 elif error == "InvalidRegistration":
                     logging.error("Invalid registration, deleting token")
-                    self.dao.remove_gcm_token(token)
+                    self.tokens_to_remove.append(token)
                 else:
                     if error == "InternalServerError":
                         logging.warn("InternalServerError in GCM: " + error)
@@ -119,11 +177,21 @@ class GCM(object):
                         logging.error("Unrecoverable error in GCM: " + error)
 
     def replace_gcm_token_with_canonical(self, token, new_token_id):
-        already_exists = new_token_id in [t.gcm_token for t in self.tokens]
+        already_exists = new_token_id in self.token_ids
 
         if already_exists:
             logging.info("Canonical token already exists, removing old one: %s" % (new_token_id))
-            self.dao.remove_gcm_token(token)
+            self.tokens_to_remove.append(token)
         else:
             logging.info("Updating token with canonical token: %s -> %s" % (token.gcm_token, new_token_id))
-            self.dao.update_gcm_token(token, new_token_id)
+            self.tokens_to_update.append((token, new_token_id))
+            self.token_ids.add(new_token_id)
+
+    def apply_gcm_results(self, message):
+        if len(self.tokens_to_remove) > 0:
+            self.dao.remove_gcm_tokens(self.tokens_to_remove)
+        if len(self.tokens_to_update) > 0:
+            self.dao.update_gcm_tokens(self.tokens_to_update)
+        if len(self.tokens_to_retry) > 0:
+            self.gcmhelper.send_gcm_to_tokens_deferred(self.tokens_to_retry, message, self.retry_attempt + 1)
+        self.reset_gcm_results()
@@ -1,6 +1,9 @@
 import logging
 from datamodels import GcmToken
 from gcm import GCM
+from gcmtransport import HttpTransport
+from fakegcm import FakeGcmServer
+from httplib import HTTPException
 import json
 import unittest
 
@@ -9,23 +12,30 @@ class MockDao():
     def __init__(self):
         self.removed_tokens = []
         self.updated_tokens = []
+        self.remove_calls = 0
+        self.update_calls = 0
 
     def load_gcm_auth_key(self):
         return '123'
 
-    def remove_gcm_token(self, token):
-        self.removed_tokens.append(token)
+    def remove_gcm_tokens(self, tokens):
+        self.remove_calls += 1
+        self.removed_tokens.extend(tokens)
 
-    def update_gcm_token(self, token, new_token_id):
-        self.updated_tokens.append((token, new_token_id))
+    def update_gcm_tokens(self, updates):
+        self.update_calls += 1
+        self.updated_tokens.extend(updates)
 
 
 class MockGcmHelper():
     def __init__(self):
         self.sent_tokens = []
+        self.send_calls = []
 
-    def send_gcm_to_token_deferred(self, token, message):
-        self.sent_tokens.append((token, message))
+    def send_gcm_to_tokens_deferred(self, tokens, message, attempt=1):
+        self.send_calls.append((tokens, message, attempt))
+        for token in tokens:
+            self.sent_tokens.append((token, message))
 
 
 class TestGcm(unittest.TestCase):
@@ -63,6 +73,11 @@ class TestGcm(unittest.TestCase):
             index += 1
             token = gcm.tokens[index]
             gcm.handle_gcm_result(result, token, message)
+        gcm.apply_gcm_results(message)
+
+        self.assertEqual(1, mock_dao.remove_calls)
+        self.assertEqual(1, mock_dao.update_calls)
+        self.assertEqual(1, len(mock_helper.send_calls))
 
         self.assertEqual(2, len(mock_dao.removed_tokens))
         self.assertEqual('2', mock_dao.removed_tokens[0].gcm_token)
@@ -75,3 +90,91 @@ class TestGcm(unittest.TestCase):
         self.assertEqual(1, len(mock_helper.sent_tokens))
         self.assertEqual('6', mock_helper.sent_tokens[0][0].gcm_token)
         self.assertEqual(message, mock_helper.sent_tokens[0][1])
+
+    def test_batched_token_mutations(self):
+        mock_dao = MockDao()
+        mock_helper = MockGcmHelper()
+        gcm = GCM(mock_dao, mock_helper)
+        gcm.retry_attempt = 2
+        gcm.tokens = [GcmToken(gcm_token=str(i)) for i in range(6)]
+
+        message = 'batch'
+        results = [{'error': 'NotRegistered'},
+                   {'error': 'InvalidRegistration'},
+                   {'error': 'Unavailable'},
+                   {'error': 'Unavailable'},
+                   {'message_id': '1', 'registration_id': 'new'},
+                   {'message_id': '2', 'registration_id': 'new'}]  # second token with the same new canonical id
+
+        for index, result in enumerate(results):
+            gcm.handle_gcm_result(result, gcm.tokens[index], message)
+
+        self.assertEqual(0, mock_dao.remove_calls)
+        self.assertEqual(0, mock_dao.update_calls)
+        self.assertEqual(0, len(mock_helper.send_calls))
+
+        gcm.apply_gcm_results(message)
+
+        self.assertEqual(1, mock_dao.remove_calls)
+        self.assertEqual(['0', '1', '5'], [t.gcm_token for t in mock_dao.removed_tokens])
+
+        self.assertEqual(1, mock_dao.update_calls)
+        self.assertEqual([('4', 'new')], [(t.gcm_token, new_id) for t, new_id in mock_dao.updated_tokens])
+
+        self.assertEqual(1, len(mock_helper.send_calls))
+        (tokens, sent_message, attempt) = mock_helper.send_calls[0]
+        self.assertEqual(['2', '3'], [t.gcm_token for t in tokens])
+        self.assertEqual(message, sent_message)
+        self.assertEqual(3, attempt)
+
+        gcm.apply_gcm_results(message)
+        self.assertEqual(1, mock_dao.remove_calls)
+        self.assertEqual(1, mock_dao.update_calls)
+        self.assertEqual(1, len(mock_helper.send_calls))
+
+
+class TestGcmTransport(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeGcmServer().start()
+        self.mock_dao = MockDao()
+        self.mock_helper = MockGcmHelper()
+        self.gcm = GCM(self.mock_dao, self.mock_helper, transport=HttpTransport(), url=self.server.url)
+
+    def tearDown(self):
+        self.gcm.transport.close()
+        self.server.stop()
+
+    def test_send_through_fake_server(self):
+        tokens = [GcmToken(gcm_token='ok'), GcmToken(gcm_token='canonical:new'),
+                  GcmToken(gcm_token='unavailable'), GcmToken(gcm_token='notregistered')]
+
+        self.gcm.send_gcm(tokens, 'first', 'summary')
+        self.gcm.send_gcm([GcmToken(gcm_token='ok')], 'second')
+
+        self.assertEqual(2, len(self.server.requests))
+        self.assertEqual(1, self.server.connection_count())  # keep-alive connection was reused
+
+        (authorization, body) = self.server.requests[0]
+        self.assertEqual('key=123', authorization)
+        request = json.loads(body)
+        self.assertEqual('first', request['data']['message'])
+        self.assertEqual('summary', request['collapse_key'])
+
+        self.assertEqual(['notregistered'], [t.gcm_token for t in self.mock_dao.removed_tokens])
+        self.assertEqual([('canonical:new', 'new')], [(t.gcm_token, new_id) for t, new_id in self.mock_dao.updated_tokens])
+        self.assertEqual(['unavailable'], [t.gcm_token for t, _ in self.mock_helper.sent_tokens])
+
+    def test_server_error_retries_task(self):
+        self.server.status = 503
+        self.assertRaises(Exception, self.gcm.send_gcm, [GcmToken(gcm_token='ok')], 'message')
+
+    def test_client_error_is_not_retried(self):
+        self.server.status = 401
+        self.gcm.send_gcm([GcmToken(gcm_token='ok')], 'message')
+        self.assertEqual(0, len(self.mock_dao.removed_tokens))
+
+    def test_slow_server_times_out(self):
+        self.server.delay = 0.5
+        self.gcm.transport = HttpTransport(timeout=0.1)
+        self.assertRaises(HTTPException, self.gcm.send_gcm, [GcmToken(gcm_token='ok')], 'message')
@@ -1,41 +1,362 @@
+import json
+import time
 import traceback
+from google.appengine.api import taskqueue
+from google.appengine.api import memcache
 from google.appengine.ext import deferred
+from google.appengine.ext import ndb
 from google.appengine.api.taskqueue import TransientError
 from gcm import GCM
+from gcmtransport import UrlfetchTransport
+from circuitbreaker import CircuitBreaker, CircuitOpenError, StateOpen, jittered_delay
+from datamodels import IrssiUser, Message
 import logging
 import dao
 import sys
 
 QueueName = 'gcmqueue'
 
+# traffic classes get their own queues so that retries for dead tokens cannot delay fresh highlights
+TrafficLive = 'live'
+TrafficCommand = 'command'
+TrafficRetry = 'retry'
+TrafficQueueNames = {TrafficLive: QueueName,
+                     TrafficCommand: 'gcmcommandqueue',
+                     TrafficRetry: 'gcmretryqueue'}
+TaskUrl = '/tasks/gcm'
+SummaryCollapseKey = 'summary'
+SuppressedSummaryInterval = 60
+UnavailableRetryBackoff = 10
+MaxUnavailableRetries = 5
 
-def send_gcm_to_user_deferred(irssiuser, message):
-    logging.info("Queuing deferred task for sending message to user %s" % irssiuser.email)
-    key = irssiuser.key
+# push task payloads are json: {'v': version, 'u': user key id, 'n': notifications} where each notification is
+# either the id of a stored Message or an inline gcm message. Optional fields: 't' token ids and 'a' attempt for
+# retries, 's' for a coalesced summary.
+TaskPayloadVersion = 1
+MaxInlineMessageSize = 1024
+# push tasks are limited to 100KB, a batch that does not fit is split over several tasks
+MaxTaskPayloadSize = 90 * 1024
+
+# in pull mode notifications are leased from a pull queue in batches and sent concurrently
+UsePullQueue = False
+PullQueueName = 'gcmpullqueue'
+PullKickInterval = 1
+PullLeaseSeconds = 60
+PullBatchSize = 100
+PullWorkerDeadline = 8 * 60
+MaxPullRetries = 5
+PullStatsKey = 'gcm-pull-stats'
+
+pull_transport = UrlfetchTransport()
+GCM.circuit_breaker = CircuitBreaker('gcm')
+
+
+def _push_task(irssiuser_key, notifications=None, countdown=None, **fields):
+    payload = {'v': TaskPayloadVersion, 'u': irssiuser_key.id()}
+    if notifications is not None:
+        payload['n'] = notifications
+    payload.update(fields)
+    return taskqueue.Task(url=TaskUrl, payload=json.dumps(payload, separators=(',', ':')), countdown=countdown)
+
+
+def _push_tasks(irssiuser_key, notifications):
+    tasks = []
+    chunk = []
+    size = 0
+    for n in notifications:
+        n_size = len(json.dumps(n)) + 1
+        if len(chunk) > 0 and size + n_size > MaxTaskPayloadSize:
+            tasks.append(_push_task(irssiuser_key, chunk))
+            chunk = []
+            size = 0
+        chunk.append(n)
+        size += n_size
+    if len(chunk) > 0:
+        tasks.append(_push_task(irssiuser_key, chunk))
+    return tasks
+
+
+def _add_push_task(task, traffic=TrafficLive):
     try:
-        deferred.defer(_send_gcm_to_user, key, message, _queue=QueueName)
+        taskqueue.Queue(TrafficQueueNames[traffic]).add(task)
     except TransientError:
         logging.warn("Transient error: %s" % traceback.format_exc())
 
 
+def _message_notification(message):
+    gcm_json = message.to_gcm_json()
+    if message.get_id() is not None and len(gcm_json) > MaxInlineMessageSize:
+        return message.get_id()
+    return gcm_json
+
+
+def decode_task_payload(payload):
+    try:
+        task = json.loads(payload)
+    except ValueError:
+        logging.error("Malformed push task payload: %s" % payload)
+        return None
+
+    if not isinstance(task, dict) or task.get('v') != TaskPayloadVersion or 'u' not in task:
+        logging.error("Unsupported push task payload: %s" % payload)
+        return None
+    return task
+
+
+def load_notifications(notifications):
+    ids = [n for n in notifications if not isinstance(n, basestring)]
+    stored = dict(zip(ids, ndb.get_multi([ndb.Key(Message, i) for i in ids])))
+
+    messages = []
+    for n in notifications:
+        if isinstance(n, basestring):
+            messages.append(n)
+        elif stored[n] is not None:
+            messages.append(stored[n].to_gcm_json())
+        else:
+            logging.warn("Message %s not found, probably wiped" % n)
+    return messages
+
+
+def send_gcm_to_user_deferred(irssiuser, message, traffic=TrafficLive):
+    logging.info("Queuing %s task for sending message to user %s" % (traffic, irssiuser.email))
+    _add_push_task(_push_task(irssiuser.key, [message]), traffic)
+
+
+@ndb.tasklet
+def send_gcm_to_user_async(irssiuser, message):
+    key = irssiuser.key
+    tasks = []
+
+    window = irssiuser.push_coalesce_window
+    if window:
+        ctx = ndb.get_context()
+        first_in_window = yield ctx.memcache_add(_coalesce_window_key(key), True, time=window)
+        if not first_in_window:
+            logging.info("Coalescing message for user %s" % irssiuser.email)
+            yield ctx.memcache_incr(_coalesce_pending_key(key), initial_value=0)
+            return
+
+        # push the first message right away, the rest of the window is summarized when it closes
+        tasks.append(_push_task(key, countdown=window, s=1))
+
+    if UsePullQueue:
+        yield _queue_pull_notification_async(key, message.to_gcm_json())
+    else:
+        logging.info("Queuing async task for sending message to user %s" % irssiuser.email)
+        tasks.append(_push_task(key, [_message_notification(message)]))
+
+    if len(tasks) > 0:
+        try:
+            yield taskqueue.Queue(QueueName).add_async(tasks)
+        except TransientError:
+            logging.warn("Transient error: %s" % traceback.format_exc())
+
+
 def _send_gcm_to_user(irssiuser_key, message):
+    # deferred tasks queued before push tasks had their own handler
     logging.info("Executing deferred task: _send_gcm_to_user, %s, %s" % (irssiuser_key, message))
     gcm = GCM(dao, sys.modules[__name__])
     gcm.send_gcm_to_user(irssiuser_key, message)
 
 
-def send_gcm_to_token_deferred(token, message):
-    logging.info("Queuing deferred task for sending message to token %s" % token.gcm_token)
-    key = token.key
+def _coalesce_window_key(irssiuser_key):
+    return "push-window-" + str(irssiuser_key.id())
+
+
+def _coalesce_pending_key(irssiuser_key):
+    return "push-pending-" + str(irssiuser_key.id())
+
+
+def get_summary_json(count):
+    return json.dumps({'summary': {'count': count, 'server_timestamp': '%f' % int(time.time())}})
+
+
+def _suppressed_summary_key(irssiuser_key):
+    return "push-suppressed-" + str(irssiuser_key.id())
+
+
+def add_suppressed_notifications(irssiuser, count):
+    # rate limited messages are folded into the same "N more messages" summary as coalesced ones. Like coalescing
+    # this is opt-in, clients that do not know about summaries drop them. Senders still get a Retry-After.
+    if not irssiuser.push_coalesce_window:
+        return
+
+    key = irssiuser.key
+    memcache.incr(_coalesce_pending_key(key), delta=count, initial_value=0)
+    if memcache.add(_suppressed_summary_key(key), True, time=SuppressedSummaryInterval):
+        _add_push_task(_push_task(key, countdown=SuppressedSummaryInterval, s=1))
+
+
+def send_coalesced_summary(irssiuser_key):
+    pending_key = _coalesce_pending_key(irssiuser_key)
+    count = int(memcache.get(pending_key) or 0)
+    logging.info("Sending coalesced summary to user %s, %s messages" % (irssiuser_key, count))
+    if count == 0:
+        return
+
+    gcm = GCM(dao, sys.modules[__name__])
+    gcm.send_gcm_to_user(irssiuser_key, get_summary_json(count), SummaryCollapseKey)
+    memcache.decr(pending_key, delta=count)
+
+
+def send_gcm_messages_to_user_deferred(irssiuser, messages):
+    key = irssiuser.key
+    window = irssiuser.push_coalesce_window
+    if window and len(messages) > 0:
+        # a batch goes through the same window as single messages: at most one push now, the rest is summarized
+        pending = len(messages)
+        tasks = []
+        if memcache.add(_coalesce_window_key(key), True, time=window):
+            tasks = [_push_task(key, [_message_notification(messages[0])]), _push_task(key, countdown=window, s=1)]
+            pending -= 1
+        if pending > 0:
+            memcache.incr(_coalesce_pending_key(key), delta=pending, initial_value=0)
+        logging.info("Coalescing %s of %s messages for user %s" % (pending, len(messages), irssiuser.email))
+        if len(tasks) > 0:
+            _add_push_task(tasks)
+        return
+
+    tasks = _push_tasks(key, [_message_notification(m) for m in messages])
+    logging.info("Queuing %s tasks for sending %s messages to user %s" % (len(tasks), len(messages), irssiuser.email))
+    _add_push_task(tasks)
+
+
+def send_gcm_to_tokens_deferred(tokens, message, attempt=1):
+    if attempt > MaxUnavailableRetries:
+        logging.warn("Giving up on %s unavailable tokens after %s retries" % (len(tokens), MaxUnavailableRetries))
+        return
+
+    countdown = UnavailableRetryBackoff * 2 ** (attempt - 1)
+    logging.info("Queuing task for retrying %s tokens in %s seconds" % (len(tokens), countdown))
+    irssiuser_key = tokens[0].key.parent()
+    _add_push_task(_push_task(irssiuser_key, [message], countdown=countdown,
+                              t=[token.key.id() for token in tokens], a=attempt), TrafficRetry)
+
+
+def _send_gcm_to_token(token_key, message):
+    # deferred tasks queued before push tasks had their own handler
+    logging.info("Executing deferred task: _send_gcm_to_token, %s, %s" % (token_key, message))
+    token = token_key.get()
+    if token is not None:
+        gcm = GCM(dao, sys.modules[__name__])
+        gcm.retry_attempt = 1
+        gcm.send_gcm([token], message)
+
+
+@ndb.tasklet
+def _queue_pull_notification_async(irssiuser_key, message):
+    logging.info("Queuing pull task for sending message to user %s" % irssiuser_key.id())
+    payload = json.dumps({'user': irssiuser_key.id(), 'message': message, 'queued': time.time()})
+    task = taskqueue.Task(payload=payload, method='PULL', tag=str(irssiuser_key.id()))
+
+    # one worker run per kick interval picks up everything queued during it
+    slot = int(time.time() / PullKickInterval)
     try:
-        deferred.defer(_send_gcm_to_token, key, message, _queue=QueueName)
+        yield taskqueue.Queue(PullQueueName).add_async(task)
     except TransientError:
         logging.warn("Transient error: %s" % traceback.format_exc())
+        return
 
+    # only the first message of a slot pays for the taskqueue RPC that schedules the worker
+    first_in_slot = yield ndb.get_context().memcache_add('gcmpull-kick-%s' % slot, True, time=PullKickInterval + 60)
+    if not first_in_slot:
+        return
+    try:
+        deferred.defer(_process_pull_queue, _name='gcmpull-%s' % slot, _queue=QueueName,
+                       _countdown=max(0, (slot + 1) * PullKickInterval - time.time()))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass  # worker already scheduled for this slot
 
-def _send_gcm_to_token(token_key, message):
-    logging.info("Executing deferred task: _send_gcm_to_token, %s, %s" % (token_key, message))
-    token = dao.get_gcm_token_for_key(token_key)
 
-    gcm = GCM(dao, sys.modules[__name__])
-    gcm.send_gcm([token], message)
+def _process_pull_queue():
+    queue = taskqueue.Queue(PullQueueName)
+    start = time.time()
+    processed = 0
+    lags = []
+
+    while time.time() - start < PullWorkerDeadline:
+        if GCM.circuit_breaker.get_state()[0] == StateOpen:
+            logging.warn("GCM circuit open, leaving notifications in the pull queue")
+            break
+
+        tasks = queue.lease_tasks(PullLeaseSeconds, PullBatchSize)
+        if len(tasks) == 0:
+            break
+
+        done = _send_pulled_notifications(tasks)
+        queue.delete_tasks(done)
+        processed += len(done)
+        lags.extend([time.time() - json.loads(t.payload)['queued'] for t in done])
+
+    elapsed = time.time() - start
+    stats = {'processed': processed,
+             'elapsed': elapsed,
+             'throughput': processed / elapsed if elapsed > 0 else 0,
+             'max_lag': max(lags) if lags else 0,
+             'avg_lag': sum(lags) / len(lags) if lags else 0,
+             'timestamp': int(time.time())}
+    logging.info("Pull queue worker done: %s" % stats)
+    memcache.set(PullStatsKey, stats)
+
+
+def _send_pulled_notifications(tasks):
+    by_user = {}
+    for task in tasks:
+        payload = json.loads(task.payload)
+        by_user.setdefault(ndb.Key(IrssiUser, payload['user']), []).append((task, payload['message']))
+    tokens = dao.get_gcm_tokens_for_user_keys(by_user.keys())
+
+    # start every request before waiting for any of them
+    sends = []
+    for user_key, notifications in by_user.items():
+        for task, message in notifications:
+            gcm = GCM(dao, sys.modules[__name__], transport=pull_transport)
+            try:
+                request = gcm.send_gcm_async(tokens[user_key], message)
+            except CircuitOpenError:
+                continue  # stays in the queue until its lease runs out
+            sends.append((task, gcm, request, message))
+
+    done = []
+    for task, gcm, request, message in sends:
+        try:
+            if request is not None:
+                gcm.handle_gcm_response(request, message)
+            done.append(task)
+        except:
+            if task.retry_count >= MaxPullRetries:
+                logging.error("Dropping notification after %s retries: %s" % (task.retry_count, traceback.format_exc()))
+                done.append(task)
+            else:
+                logging.warn("Unable to send notification, leaving it to the queue: %s" % traceback.format_exc())
+    return done
+
+
+def get_queue_stats():
+    queue_names = [TrafficQueueNames[t] for t in [TrafficLive, TrafficCommand, TrafficRetry]] + [PullQueueName]
+    now_usec = time.time() * 1e6
+    stats = {}
+    for queue_stats in taskqueue.QueueStatistics.fetch([taskqueue.Queue(name) for name in queue_names]):
+        oldest_age = 0
+        if queue_stats.oldest_eta_usec is not None:
+            oldest_age = max(0, (now_usec - queue_stats.oldest_eta_usec) / 1e6)
+        stats[queue_stats.queue.name] = {'tasks': queue_stats.tasks,
+                                         'oldest_task_age': oldest_age,
+                                         'executed_last_minute': queue_stats.executed_last_minute,
+                                         'in_flight': queue_stats.in_flight}
+    return stats
+
+
+def hold_push_task(queue_name, payload, retry_after):
+    countdown = jittered_delay(retry_after)
+    logging.warn("GCM circuit open, holding push task for %s seconds" % countdown)
+    taskqueue.Queue(queue_name).add(taskqueue.Task(url=TaskUrl, payload=payload, countdown=countdown))
+
+
+def get_circuit_breaker_stats():
+    return GCM.circuit_breaker.get_stats()
+
+
+def get_pull_worker_stats():
+    return memcache.get(PullStatsKey)
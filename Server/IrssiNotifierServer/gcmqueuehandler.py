@@ -0,0 +1,51 @@
+import webapp2
+import logging
+from google.appengine.ext import ndb
+from datamodels import IrssiUser, GcmToken
+from gcm import GCM
+from circuitbreaker import CircuitOpenError
+import dao
+import gcmhelper
+
+
+class GcmTaskController(webapp2.RequestHandler):
+    def post(self):
+        logging.info("Executing push task, retry count %s" % self.request.headers.get('X-AppEngine-TaskRetryCount'))
+        task = gcmhelper.decode_task_payload(self.request.body)
+        if task is None:
+            return  # retrying would not help
+
+        try:
+            self.send(task)
+        except CircuitOpenError as e:
+            # requeue instead of failing so that the queue's own retry backoff does not grow during the outage
+            queue_name = self.request.headers.get('X-AppEngine-QueueName', gcmhelper.QueueName)
+            gcmhelper.hold_push_task(queue_name, self.request.body, e.retry_after)
+
+    def send(self, task):
+        irssiuser_key = ndb.Key(IrssiUser, task['u'])
+
+        if task.get('s'):
+            gcmhelper.send_coalesced_summary(irssiuser_key)
+            return
+
+        messages = gcmhelper.load_notifications(task.get('n', []))
+        gcm = GCM(dao, gcmhelper)
+
+        if 't' in task:
+            token_keys = [ndb.Key(GcmToken, token_id, parent=irssiuser_key) for token_id in task['t']]
+            tokens = [token for token in ndb.get_multi(token_keys) if token is not None]
+            gcm.retry_attempt = task.get('a', 1)
+            for message in messages:
+                gcm.send_gcm(tokens, message)
+            return
+
+        if len(messages) == 1:
+            gcm.send_gcm_to_user(irssiuser_key, messages[0])
+        else:
+            gcm.send_gcm_messages_to_user(irssiuser_key, messages)
+
+
+app = webapp2.WSGIApplication([(gcmhelper.TaskUrl, GcmTaskController)], debug=True)
+
+logging.debug("loaded gcmqueuehandler")
@@ -0,0 +1,123 @@
+import httplib
+import logging
+import socket
+import sys
+import threading
+import urlparse
+from google.appengine.api import urlfetch
+
+DefaultTimeout = 10
+
+
+class TransportError(Exception):
+    pass
+
+
+class CompletedRequest(object):
+    """Result of a request that was already made synchronously, looks like an async one to the caller."""
+
+    def __init__(self, func, *args):
+        self.result = None
+        self.exc_info = None
+        try:
+            self.result = func(*args)
+        except:
+            self.exc_info = sys.exc_info()
+
+    def get_result(self):
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+class HttpTransport(object):
+    """Posts with httplib, keeping one keep-alive connection per host for each thread.
+
+    On App Engine this needs GAE_USE_SOCKETS_HTTPLIB and the ssl library (see app.yaml), otherwise httplib is
+    backed by URL Fetch and nothing is kept alive. Idle sockets are reclaimed by the Sockets API after a couple of
+    minutes, a request on such a connection is retried once on a fresh one.
+    """
+
+    def __init__(self, timeout=DefaultTimeout):
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _get_connection(self, scheme, host):
+        connections = getattr(self.local, 'connections', None)
+        if connections is None:
+            connections = self.local.connections = {}
+
+        connection = connections.get((scheme, host))
+        if connection is not None:
+            return connection, True
+
+        logging.debug("Opening new connection to %s://%s" % (scheme, host))
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(host, timeout=self.timeout)
+        else:
+            connection = httplib.HTTPConnection(host, timeout=self.timeout)
+        connections[(scheme, host)] = connection
+        return connection, False
+
+    def _close_connection(self, scheme, host):
+        connection = self.local.connections.pop((scheme, host), None)
+        if connection is not None:
+            connection.close()
+
+    def close(self):
+        for connection in getattr(self.local, 'connections', {}).values():
+            connection.close()
+        self.local.connections = {}
+
+    def post(self, url, headers, body):
+        parsed = urlparse.urlsplit(url)
+        path = parsed.path or '/'
+
+        while True:
+            connection, reused = self._get_connection(parsed.scheme, parsed.netloc)
+            try:
+                connection.request('POST', path, body, headers)
+                response = connection.getresponse()
+                response_body = response.read()
+                if response.will_close:
+                    self._close_connection(parsed.scheme, parsed.netloc)
+                return response.status, response_body
+            except socket.timeout as e:
+                self._close_connection(parsed.scheme, parsed.netloc)
+                raise TransportError(e)
+            except (httplib.HTTPException, socket.error) as e:
+                self._close_connection(parsed.scheme, parsed.netloc)
+                # the server may have closed an idle kept-alive connection, try once more on a fresh one
+                if not reused:
+                    raise TransportError(e)
+
+    def post_async(self, url, headers, body):
+        return CompletedRequest(self.post, url, headers, body)
+
+
+class UrlfetchRequest(object):
+    def __init__(self, rpc):
+        self.rpc = rpc
+
+    def get_result(self):
+        try:
+            response = self.rpc.get_result()
+        except urlfetch.Error as e:
+            raise TransportError(e)
+        return response.status_code, response.content
+
+
+class UrlfetchTransport(object):
+    """Posts with async urlfetch calls so that many requests can be in flight at once."""
+
+    def __init__(self, timeout=DefaultTimeout):
+        self.timeout = timeout
+
+    def post(self, url, headers, body):
+        return self.post_async(url, headers, body).get_result()
+
+    def post_async(self, url, headers, body):
+        rpc = urlfetch.create_rpc(deadline=self.timeout)
+        urlfetch.make_fetch_call(rpc, url, payload=body, method=urlfetch.POST, headers=headers,
+                                 follow_redirects=False)
+        return UrlfetchRequest(rpc)
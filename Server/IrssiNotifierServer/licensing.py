@@ -1,14 +1,21 @@
 import base64
+import hashlib
 import logging
+import urllib
 from Crypto.Hash import SHA
 from Crypto.PublicKey import RSA
 from Crypto.Signature import PKCS1_v1_5
+from google.appengine.api import memcache
 import dao
 
+# the same signed data is often sent again, its verification result is remembered
+LicenseResultCacheTime = 24 * 60 * 60
+
 
 class Licensing(object):
     public_key = None
     public_key_base64 = None
+    verifier = None
 
     def __init__(self):
         if Licensing.public_key_base64 is None:
@@ -18,10 +25,18 @@ class Licensing(object):
 
             # Key from Google Play is a X.509 subjectPublicKeyInfo DER SEQUENCE.
             Licensing.public_key = RSA.importKey(base64.standard_b64decode(Licensing.public_key_base64))
+            # Scheme is RSASSA-PKCS1-v1_5.
+            Licensing.verifier = PKCS1_v1_5.new(Licensing.public_key)
 
     def check_license(self, irssi_user, signed_data, signature):
-        signed_data = signed_data.replace('%3D', '=').replace('%26', '&').replace('%2F', '/').replace('%2B', '+')
-        signature = signature.replace('%3D', '=').replace('%26', '&').replace('%2F', '/').replace('%2B', '+')
+        signed_data = urllib.unquote(signed_data)
+        signature = urllib.unquote(signature)
+
+        cache_key = 'license-' + hashlib.sha1('\0'.join([str(irssi_user.key.id()), signed_data, signature])).hexdigest()
+        cached = memcache.get(cache_key)
+        if cached is False:
+            logging.info("Verified (cached): False")
+            return False
 
         try:
             split = signed_data.split(':')
@@ -45,22 +60,34 @@ class Licensing(object):
             logging.error("Invalid response code: %s" % response_code)
             return False
 
+        # the license may be gone with a wipe, then it has to be verified and saved again
+        existing = dao.get_license(irssi_user, package_name, user_id)
+        if cached is True and existing is not None:
+            logging.info("Verified (cached): True")
+            return True
+
         old_nonce = dao.get_nonce(irssi_user, nonce)
         if old_nonce is None:
-            logging.error("Nonces do not match! given: %s" % nonce)
-            return False
+            # nonces are deleted after use, a retry of an already saved response is verified without one
+            if existing is None or existing.nonce != nonce:
+                logging.error("Nonces do not match! given: %s" % nonce)
+                return False
+            logging.info("Nonce already used by the saved license, verifying again")
 
         h = SHA.new()
         h.update(signed_data)
-        # Scheme is RSASSA-PKCS1-v1_5.
-        verifier = PKCS1_v1_5.new(Licensing.public_key)
         # The signature is base64 encoded.
         signature = base64.standard_b64decode(signature)
-        verified = verifier.verify(h, signature)
+        verified = Licensing.verifier.verify(h, signature)
 
         logging.info("Verified: %s " % verified)
 
         if verified:
-            dao.save_license(irssi_user, response_code, nonce, package_name, version_code, user_id, timestamp, extra_data)
+            dao.save_license(irssi_user, response_code, nonce, package_name, version_code, user_id, timestamp,
+                             extra_data)
+            if old_nonce is not None:
+                dao.remove_nonce(irssi_user, old_nonce)
 
+        # only remembered once the license is saved, a retry after a failed save goes through all of this again
+        memcache.set(cache_key, verified, time=LicenseResultCacheTime)
         return verified
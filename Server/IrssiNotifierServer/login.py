@@ -29,6 +29,9 @@ def get_irssi_user(params):
         user_id = federated_identity
 
     irssi_user = dao.get_irssi_user_for_key_name(user_id)
+    if irssi_user is not None and irssi_user.wiping:
+        logging.info("IrssiUser is being wiped, rejecting")
+        return None
     if irssi_user is None:
         logging.debug("IrssiUser not found, adding new one")
         irssi_user = dao.add_irssi_user(user, user_id)
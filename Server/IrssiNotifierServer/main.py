@@ -14,11 +14,13 @@ app = webapp2.WSGIApplication(
     [('/', WebController),
      ('/API/Settings', SettingsController),
      ('/API/Message', MessageController),
+     ('/API/Messages', MessageBatchController),
      ('/API/Command', CommandController),
      ('/API/Wipe', WipeController),
      ('/API/Nonce', NonceController),
      ('/API/License', LicensingController),
      ('/admin', AdminController),
+     ('/admin/stats', StatsController),
      ('/analytics', AnalyticsController)],
     debug=True)
 
@@ -0,0 +1,108 @@
+"""Compact storage of the encrypted message fields.
+
+The clients send each field as the output of openssl enc in url-safe base64 without padding. Those fields are
+stored as the raw bytes, anything that does not round-trip exactly is kept as text. The fields are packed into
+one blob that is compressed with zlib when that makes it smaller.
+
+Blob layout: a header byte with the format version and the compressed flag, then for each field a type byte,
+the length as a varint and the data.
+"""
+
+import base64
+import binascii
+import zlib
+
+FormatVersion = 1
+FlagCompressed = 0x80
+
+FieldNone = 0
+FieldText = 1
+FieldBase64 = 2
+
+
+def _encode_base64(data):
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+def _decode_base64(value):
+    try:
+        value = value.encode('ascii')
+    except UnicodeError:
+        return None
+    try:
+        data = base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+    except (TypeError, binascii.Error):
+        return None
+    if _encode_base64(data) != value:
+        return None  # not canonical, it would not come back the same
+    return data
+
+
+def _write_varint(out, n):
+    while n >= 0x80:
+        out.append(chr((n & 0x7f) | 0x80))
+        n >>= 7
+    out.append(chr(n))
+
+
+def _read_varint(blob, pos):
+    n = 0
+    shift = 0
+    while True:
+        b = ord(blob[pos])
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def encode_fields(values):
+    out = []
+    for value in values:
+        if value is None:
+            out.append(chr(FieldNone))
+            continue
+
+        data = _decode_base64(value)
+        if data is not None:
+            out.append(chr(FieldBase64))
+        else:
+            data = value.encode('utf-8')
+            out.append(chr(FieldText))
+        _write_varint(out, len(data))
+        out.append(data)
+
+    body = ''.join(out)
+    compressed = zlib.compress(body, 6)
+    if len(compressed) < len(body):
+        return chr(FormatVersion | FlagCompressed) + compressed
+    return chr(FormatVersion) + body
+
+
+def decode_fields(blob):
+    header = ord(blob[0])
+    if header & ~FlagCompressed != FormatVersion:
+        raise ValueError("Unknown message blob format %s" % header)
+
+    body = blob[1:]
+    if header & FlagCompressed:
+        body = zlib.decompress(body)
+
+    values = []
+    pos = 0
+    while pos < len(body):
+        field_type = ord(body[pos])
+        pos += 1
+        if field_type == FieldNone:
+            values.append(None)
+            continue
+
+        (length, pos) = _read_varint(body, pos)
+        data = body[pos:pos + length]
+        pos += length
+        if field_type == FieldBase64:
+            values.append(unicode(_encode_base64(data)))
+        else:
+            values.append(data.decode('utf-8'))
+    return values
@@ -0,0 +1,40 @@
+import base64
+import os
+import unittest
+import messagecodec
+
+
+def encrypted(length):
+    # what the clients send: openssl enc output in url-safe base64 without padding
+    return unicode(base64.urlsafe_b64encode('Salted__' + os.urandom(8 + length)).rstrip('='))
+
+
+class TestMessageCodec(unittest.TestCase):
+
+    def test_round_trip(self):
+        values = [encrypted(100), encrypted(16), encrypted(1)]
+        blob = messagecodec.encode_fields(values)
+        self.assertEqual(values, messagecodec.decode_fields(blob))
+        self.assertTrue(len(blob) < sum(len(v) for v in values))
+
+    def test_fields_that_are_not_canonical_base64_are_kept_as_text(self):
+        values = [u'plain text \xe4', u'abcde', u'YWJj+/==', u'YWJ\nj', u'YR', u'']
+        for value in values:
+            blob = messagecodec.encode_fields([value])
+            self.assertEqual([value], messagecodec.decode_fields(blob))
+
+    def test_none_fields(self):
+        values = [None, encrypted(32), None]
+        self.assertEqual(values, messagecodec.decode_fields(messagecodec.encode_fields(values)))
+
+    def test_compresses_when_smaller(self):
+        values = [u'repeated ' * 100, encrypted(32), u'#channel']
+        blob = messagecodec.encode_fields(values)
+        self.assertTrue(ord(blob[0]) & messagecodec.FlagCompressed)
+        self.assertEqual(values, messagecodec.decode_fields(blob))
+
+        blob = messagecodec.encode_fields([encrypted(64)])
+        self.assertFalse(ord(blob[0]) & messagecodec.FlagCompressed)
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, messagecodec.decode_fields, chr(messagecodec.FormatVersion + 1))
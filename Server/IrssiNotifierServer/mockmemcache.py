@@ -0,0 +1,42 @@
+"""An in-process stand-in for the memcache client, for tests of code that takes a client argument."""
+
+
+class MockMemcache():
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def get_multi(self, keys):
+        return dict((k, self.values[k]) for k in keys if k in self.values)
+
+    def set(self, key, value, time=0):
+        self.values[key] = value
+
+    def add(self, key, value, time=0):
+        if key in self.values:
+            return False
+        self.values[key] = value
+        return True
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.delete(key)
+
+    def incr(self, key, delta=1, initial_value=None):
+        self.values[key] = self.values.get(key, initial_value) + delta
+        return self.values[key]
+
+    def offset_multi(self, mapping, initial_value=None):
+        return dict((k, self.incr(k, delta, initial_value)) for k, delta in mapping.items())
+
+    def gets(self, key):
+        return self.get(key)
+
+    def cas(self, key, value, time=0):
+        self.values[key] = value
+        return True
@@ -0,0 +1,43 @@
+import logging
+import time
+from google.appengine.api import memcache
+
+# token bucket per api token: bursts of up to BucketSize messages, refilled at RefillRate messages per second
+BucketSize = 120
+RefillRate = 1.0
+BucketTime = 60 * 60
+MaxCasRetries = 5
+
+
+def _bucket_key(api_token):
+    return "rate-bucket-" + str(api_token)
+
+
+def take(api_token, count=1, client=None):
+    """Takes count tokens from the bucket of api_token.
+
+    Returns 0 when the request may proceed, otherwise the number of seconds until enough tokens are available.
+    """
+    if client is None:
+        client = memcache.Client()  # gets/cas state is per client, do not share it between threads
+    key = _bucket_key(api_token)
+
+    for i in range(MaxCasRetries):
+        now = time.time()
+        bucket = client.gets(key)
+        if bucket is None:
+            if count > BucketSize:
+                return (count - BucketSize) / RefillRate
+            if client.add(key, (BucketSize - count, now), time=BucketTime):
+                return 0
+            continue
+
+        (tokens, updated) = bucket
+        tokens = min(BucketSize, tokens + (now - updated) * RefillRate)
+        if tokens < count:
+            return (count - tokens) / RefillRate
+        if client.cas(key, (tokens - count, now), time=BucketTime):
+            return 0
+
+    logging.warn("Rate limit bucket for %s is too contended, letting request through" % api_token)
+    return 0
@@ -0,0 +1,38 @@
+import time
+import unittest
+import ratelimit
+from mockmemcache import MockMemcache
+
+
+class TestRateLimit(unittest.TestCase):
+
+    def setUp(self):
+        self.client = MockMemcache()
+
+    def test_limit(self):
+        self.assertEqual(0, ratelimit.take('token', ratelimit.BucketSize - 1, client=self.client))
+        self.assertEqual(0, ratelimit.take('token', client=self.client))
+
+        retry_after = ratelimit.take('token', client=self.client)
+        self.assertTrue(0 < retry_after <= 1 / ratelimit.RefillRate)
+        self.assertEqual(0, ratelimit.take('other', client=self.client))
+
+    def test_retry_after_covers_the_whole_request(self):
+        self.assertEqual(0, ratelimit.take('token', ratelimit.BucketSize, client=self.client))
+        retry_after = ratelimit.take('token', 10, client=self.client)
+        self.assertAlmostEqual(10 / ratelimit.RefillRate, retry_after, places=1)
+
+        self.assertAlmostEqual(5 / ratelimit.RefillRate,
+                               ratelimit.take('new', ratelimit.BucketSize + 5, client=self.client))
+
+    def test_refill(self):
+        self.assertEqual(0, ratelimit.take('token', ratelimit.BucketSize, client=self.client))
+        (tokens, updated) = self.client.get(ratelimit._bucket_key('token'))
+        self.client.set(ratelimit._bucket_key('token'), (tokens, updated - 10 / ratelimit.RefillRate))
+
+        self.assertEqual(0, ratelimit.take('token', 10, client=self.client))
+        self.assertTrue(ratelimit.take('token', client=self.client) > 0)
+
+        self.client.set(ratelimit._bucket_key('token'), (0, time.time() - 1000 * ratelimit.BucketSize))
+        self.assertEqual(0, ratelimit.take('token', ratelimit.BucketSize, client=self.client))
+        self.assertTrue(ratelimit.take('token', client=self.client) > 0)  # refill stops at the bucket size